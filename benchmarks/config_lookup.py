@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+'''
+Microbenchmark comparing clay.config.get against the nested dict walk it
+replaced, for present, nested and missing keys.
+
+Usage: python benchmarks/config_lookup.py
+'''
+from __future__ import absolute_import, print_function
+import functools
+import timeit
+
+from clay import config
+
+
+CONFIG = config.ConfigDict({
+    'debug': {'enabled': False, 'logging': True},
+    'statsd': {'host': '127.0.0.1', 'port': 8125, 'protocol': 'udp'},
+    'database': {'pool': {'max_size': 10, 'timeout': 1.0}},
+})
+
+
+BENCHMARKS = [
+    'statsd.host',
+    'database.pool.max_size',
+    'statsd.missing',
+]
+
+
+def main(number=1000000):
+    for key in BENCHMARKS:
+        for name, func in (('walk', functools.partial(config.walk, CONFIG)),
+                           ('index', CONFIG.lookup)):
+            call = functools.partial(func, key)
+            elapsed = min(timeit.repeat(call, number=number, repeat=3))
+            print('%-6s %-24s %8.1f ns/call' % (name, key, elapsed / number * 1e9))
+
+
+if __name__ == '__main__':
+    main()
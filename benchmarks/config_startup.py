@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+'''
+Measures how long clay.config takes to parse a large config file, with and
+without the compiled config cache enabled by CLAY_CONFIG_CACHE_DIR.
+
+Usage: python benchmarks/config_startup.py [yaml|json]
+'''
+from __future__ import absolute_import, print_function
+import tempfile
+import shutil
+import json
+import time
+import sys
+import os
+
+import yaml
+
+from clay import config
+
+
+def generate(path, filetype, services=2000):
+    values = {
+        'services': dict(('service%d' % i, {
+            'host': '10.0.%d.%d' % (i // 256, i % 256),
+            'port': 8000 + i,
+            'timeout': 1.5,
+            'tags': ['a', 'b', 'c'],
+            'enabled': i % 2 == 0,
+        }) for i in range(services)),
+    }
+    with open(path, 'w') as fd:
+        if filetype == 'yaml':
+            yaml.safe_dump(values, fd)
+        else:
+            json.dump(values, fd)
+
+
+def measure(path, repeat=5):
+    best = None
+    for i in range(repeat):
+        conf = config.FileConfiguration()
+        start = time.time()
+        conf.parse_file(path)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(filetype='yaml'):
+    wd = tempfile.mkdtemp()
+    try:
+        path = os.path.join(wd, 'service.%s' % filetype)
+        generate(path, filetype)
+        os.environ.pop('CLAY_CONFIG_CACHE_DIR', None)
+        print('%-8s %8.1f ms' % ('parse', measure(path) * 1000))
+
+        os.environ['CLAY_CONFIG_CACHE_DIR'] = os.path.join(wd, 'cache')
+        config.FileConfiguration().parse_file(path)
+        print('%-8s %8.1f ms' % ('cached', measure(path) * 1000))
+    finally:
+        shutil.rmtree(wd)
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
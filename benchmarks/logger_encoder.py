@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+'''
+Benchmark of log records serialized per second per core by
+clay.logger.RecordEncoder, compared with the jsonify() implementation it
+replaced in TCPHandler and UDPHandler.
+
+Usage: python benchmarks/logger_encoder.py
+'''
+from __future__ import absolute_import, print_function
+from datetime import datetime
+import logging
+import socket
+import json
+import time
+
+from clay import logger
+
+
+def legacy_jsonify(record, hostname=socket.gethostname().split('.', 1)[0]):
+    timestamp = datetime.utcfromtimestamp(record.created)
+    timestamp = timestamp.isoformat()
+
+    fields = {
+        'level': record.levelname,
+        'filename': record.pathname,
+        'lineno': record.lineno,
+        'method': record.funcName,
+    }
+    log = {
+        '@source_host': hostname,
+        '@timestamp': timestamp,
+        '@tags': [record.name],
+        '@message': record.getMessage(),
+        '@fields': fields,
+    }
+    return json.dumps(log)
+
+
+def records_per_second(encode, records, duration=2.0):
+    count = 0
+    start = time.time()
+    while time.time() - start < duration:
+        for record in records:
+            encode(record)
+        count += len(records)
+    return count / (time.time() - start)
+
+
+def main():
+    records = [logging.LogRecord('myapp.views', logging.INFO, __file__, i,
+                                 'Handled request %i in %.03fms', (i, i / 7.0), None)
+               for i in range(1000)]
+    encoders = [('legacy jsonify', legacy_jsonify)]
+    for name in logger.JSON_MODULES:
+        try:
+            encoder = logger.RecordEncoder(json_module=name)
+        except ImportError:
+            continue
+        encoders.append(('RecordEncoder (%s)' % name, encoder.encode))
+
+    for name, encode in encoders:
+        print('%-28s %10.0f records/sec' % (name, records_per_second(encode, records)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+'''
+Microbenchmark comparing the per-call overhead of the clay.stats module
+functions against preallocated metric handles. Socket I/O is replaced with a
+no-op so that only the client-side formatting and dispatch cost is measured.
+
+Usage: python benchmarks/stats_handles.py
+'''
+from __future__ import absolute_import, print_function
+import timeit
+
+from clay import stats
+
+
+class NullConnection(object):
+    max_packet_size = stats.UDP_MAX_PACKET_SIZE
+
+    def send(self, stat):
+        if not stat.endswith('\n'):
+            stat += '\n'
+        return True
+
+    def flush(self):
+        return True
+
+    def close(self, timeout=None):
+        pass
+
+stats.connection = NullConnection()
+calls = stats.counter('api.calls')
+duration = stats.timer('api.duration')
+
+
+@stats.wrapper('api.wrapped')
+def wrapped():
+    pass
+
+
+BENCHMARKS = [
+    ('count()', lambda: stats.count('api.calls', 1)),
+    ('counter().incr()', lambda: calls.incr()),
+    ('timing()', lambda: stats.timing('api.duration', 12.5)),
+    ('timer().record()', lambda: duration.record(12.5)),
+    ('wrapper()', wrapped),
+]
+
+
+def main(number=1000000):
+    for name, func in BENCHMARKS:
+        elapsed = min(timeit.repeat(func, number=number, repeat=3))
+        print('%-20s %8.1f ns/call' % (name, elapsed / number * 1e9))
+
+
+if __name__ == '__main__':
+    main()
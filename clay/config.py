@@ -1,15 +1,27 @@
 from __future__ import absolute_import
 
 import logging.config
+import ctypes.util
+import functools
+import itertools
+import threading
+import hashlib
 import logging
+import marshal
 import random
+import select
 import signal
+import struct
+import ctypes
+import errno
 import json
+import zlib
 import time
 import os.path
 import os
 import sys
 
+import six
 
 SERIALIZERS = {'json': json}
 
@@ -19,6 +31,257 @@ try:
 except ImportError:
     pass
 
+# Seconds between checks for changed config files when watching
+WATCH_INTERVAL = 1.0
+
+# Bump when the format of cache files changes
+CACHE_VERSION = 1
+
+
+# Placeholder for keys that aren't present in a ConfigDict index
+MISSING = object()
+
+
+def flatten(config, prefix=''):
+    '''
+    Yields (dotted key, value) pairs for every value in the given nested
+    dict, including the nested dicts themselves. Keys that can't be reached by
+    splitting a dotted key (non-string keys or keys containing a dot) are
+    skipped.
+    '''
+    for key, value in config.items():
+        if not isinstance(key, six.string_types) or '.' in key:
+            continue
+        key = prefix + key
+        yield key, value
+        if isinstance(value, dict):
+            for item in flatten(value, key + '.'):
+                yield item
+
+
+def fmix32(h):
+    '''
+    The MurmurHash3 32 bit finalizer, which spreads every input bit over
+    the whole output.
+    '''
+    h ^= h >> 16
+    h = (h * 0x85ebca6b) & 0xffffffff
+    h ^= h >> 13
+    h = (h * 0xc2b2ae35) & 0xffffffff
+    h ^= h >> 16
+    return h
+
+
+class FeatureFlag(object):
+    '''
+    A feature from the "features" config section, compiled once when the
+    configuration is loaded. A feature with a percent is enabled for that
+    percentage of checks: randomly, or consistently for the same entity if
+    one is given.
+    '''
+    def __init__(self, name, enabled=False, percent=None):
+        self.name = name
+        self.enabled = enabled
+        self.seed = zlib.crc32(name.encode('utf-8'))
+        self.fraction = None
+        self.threshold = None
+        if percent is not None:
+            self.fraction = min(max(float(percent) / 100.0, 0.0), 1.0)
+            self.threshold = int(self.fraction * 0x100000000)
+
+    @classmethod
+    def from_config(cls, name, feature):
+        '''
+        Returns a FeatureFlag for the given feature config, which is treated
+        as disabled if it isn't a dict or has an invalid percent.
+        '''
+        if not isinstance(feature, dict):
+            return cls(name)
+        try:
+            return cls(name, feature.get('enabled', False), feature.get('percent'))
+        except (TypeError, ValueError):
+            logging.getLogger('clay.config').warning(
+                'Invalid percent for feature %s: %r' % (name, feature.get('percent')))
+            return cls(name)
+
+    def bucket(self, entity):
+        '''
+        Returns a 32 bit hash of this feature and the given entity id
+        '''
+        if not isinstance(entity, six.binary_type):
+            entity = six.text_type(entity).encode('utf-8')
+        return fmix32(zlib.crc32(entity, self.seed) & 0xffffffff)
+
+    def check(self, entity=None):
+        if self.threshold is None:
+            return self.enabled
+        if entity is None:
+            return (random.random() < self.fraction)
+        return (self.bucket(entity) < self.threshold)
+
+
+def compile_features(features):
+    '''
+    Returns a dict mapping feature names to FeatureFlag instances for the
+    given "features" config section.
+    '''
+    if not isinstance(features, dict):
+        return {}
+    return dict((name, FeatureFlag.from_config(name, feature))
+                for name, feature in features.items())
+
+
+def walk(config, key, default=None):
+    '''
+    Returns the value for the given dotted key by walking the nested dicts in
+    config, or default if any part of the key does not exist.
+    '''
+    value = config
+    for k in key.split('.'):
+        try:
+            value = value[k]
+        except KeyError:
+            return default
+    return value
+
+
+class ConfigDict(dict):
+    '''
+    A dict of configuration values which keeps a flattened index of every
+    dotted key, so that lookups don't need to walk the nested dicts. The
+    index and the compiled feature flags are built on first use and
+    discarded whenever the top level of the dict is modified. Nested values
+    should not be modified in place.
+    '''
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self._index = None
+        self._features = None
+
+    @property
+    def index(self):
+        index = self._index
+        if index is None:
+            index = dict(flatten(self))
+            self._index = index
+        return index
+
+    def lookup(self, key, default=None):
+        '''
+        Returns the value for the given dotted key, or default if any part of
+        the key does not exist.
+        '''
+        value = self.index.get(key, MISSING)
+        if value is MISSING:
+            return default
+        return value
+
+    @property
+    def features(self):
+        '''
+        A dict mapping the name of each feature in the "features" section to
+        a compiled FeatureFlag.
+        '''
+        features = self._features
+        if features is None:
+            features = compile_features(self.lookup('features'))
+            self._features = features
+        return features
+
+    def invalidate(self):
+        self._index = None
+        self._features = None
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self.invalidate()
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self.invalidate()
+
+    def clear(self):
+        dict.clear(self)
+        self.invalidate()
+
+    def pop(self, *args):
+        self.invalidate()
+        return dict.pop(self, *args)
+
+    def popitem(self):
+        self.invalidate()
+        return dict.popitem(self)
+
+    def setdefault(self, key, default=None):
+        self.invalidate()
+        return dict.setdefault(self, key, default)
+
+    def update(self, *args, **kwargs):
+        dict.update(self, *args, **kwargs)
+        self.invalidate()
+
+
+class ConfigSnapshot(object):
+    '''
+    A consistent, versioned view of the configuration as it was when it was
+    loaded. Reloading the configuration replaces the current snapshot rather
+    than modifying it, so code that holds on to a snapshot (for the duration
+    of a request, for example) sees the same values throughout. Snapshots
+    are not frozen: they share the config dict, so modifying that in place
+    (CONFIG.config['x'] = ...) also changes snapshots already handed out.
+    They are only consistent as long as the config is treated as read-only.
+
+    If config is a plain dict rather than a ConfigDict, it is walked on every
+    lookup, so that changes made to it in place (by tests, for example) are
+    visible.
+    '''
+    def __init__(self, config, version, last_updated=None):
+        self.config = config
+        self.version = version
+        self.last_updated = last_updated
+        if isinstance(config, ConfigDict):
+            self.lookup = config.lookup
+        else:
+            self.lookup = functools.partial(walk, config)
+
+    @property
+    def features(self):
+        if isinstance(self.config, ConfigDict):
+            return self.config.features
+        return compile_features(self.lookup('features'))
+
+    def get(self, key, default=None):
+        '''
+        Get the configuration for a specific variable, using dots as
+        delimiters for nested objects.
+        '''
+        return self.lookup(key, default)
+
+    def feature_flag(self, name, entity=None):
+        '''
+        Returns a boolean value for the given feature, which may be
+        probabalistic. If an entity id is given, the result is always the
+        same for that entity.
+        '''
+        flag = self.features.get(name)
+        if flag is None:
+            return False
+        return flag.check(entity)
+
+    def feature_flags(self, entity=None, names=None):
+        '''
+        Returns a dict of the boolean values of the named features, or all
+        configured features, for the given entity.
+        '''
+        features = self.features
+        if names is None:
+            names = features.keys()
+        result = {}
+        for name in names:
+            flag = features.get(name)
+            result[name] = flag is not None and flag.check(entity)
+        return result
+
 
 class Configuration(object):
     '''
@@ -26,10 +289,52 @@ class Configuration(object):
     '''
     def __init__(self):
         self.paths = []
-        self.config = {}
-        self.last_updated = None
+        self.versions = itertools.count()
+        self.current = ConfigSnapshot(ConfigDict(), next(self.versions))
+        self.replaced = []
         self.init_logging()
 
+    @property
+    def config(self):
+        return self.current.config
+
+    @config.setter
+    def config(self, config):
+        self.replaced.append(self.current)
+        self.publish(config)
+
+    @config.deleter
+    def config(self):
+        # Undoes the last assignment to config, which is how
+        # mock.patch.object(CONFIG, 'config', ...) restores it
+        if not self.replaced:
+            raise AttributeError('config')
+        previous = self.replaced.pop()
+        self.publish(previous.config, previous.last_updated)
+
+    @property
+    def last_updated(self):
+        return self.current.last_updated
+
+    def publish(self, config, last_updated=None):
+        '''
+        Replace the current configuration with the given dict. Readers see
+        either the old or the new configuration, never a mix of the two.
+        '''
+        if isinstance(config, ConfigDict):
+            # Build the lookup index and feature flags before the config
+            # becomes visible
+            config.index
+            config.features
+        self.current = ConfigSnapshot(config, next(self.versions), last_updated)
+        return self.current
+
+    def snapshot(self):
+        '''
+        Returns the current ConfigSnapshot
+        '''
+        return self.current
+
     def load(self, signum=None, frame=None):
         '''
         Called when the configuration should be loaded. May be called multiple
@@ -54,14 +359,7 @@ class Configuration(object):
         the value of self.config['api']['host'] or None if any of those keys
         does not exist. The default return value can be overridden.
         '''
-        value = self.config
-        for k in key.split('.'):
-            try:
-                value = value[k]
-            except KeyError:
-                return default
-        #sys.stderr.write('config: %s=%r\n' % (key, value))
-        return value
+        return self.current.lookup(key, default)
 
     def init_logging(self):
         '''
@@ -101,21 +399,104 @@ class Configuration(object):
             log.setLevel(logging.INFO)
         return log
 
-    def feature_flag(self, name):
+    def feature_flag(self, name, entity=None):
         '''
         Returns a boolean value for the given feature, which may be
-        probabalistic.
+        probabalistic. If an entity id is given, the result is always the
+        same for that entity.
         '''
-        feature = self.get('features.%s' % name)
-        if not feature:
-            return False
-        if 'percent' in feature:
-            percent = float(feature['percent']) / 100.0
-            return (random.random() < percent)
-        return feature.get('enabled', False)
+        return self.current.feature_flag(name, entity)
+
+    def feature_flags(self, entity=None, names=None):
+        '''
+        Returns a dict of the boolean values of the named features, or all
+        configured features, for the given entity.
+        '''
+        return self.current.feature_flags(entity, names)
+
+
+class ConfigCache(object):
+    '''
+    Caches parsed config files in a directory as marshal data, so that
+    processes starting up don't need to parse unchanged JSON or YAML again.
+    Entries are keyed by the config file's path and are only used if the
+    file's key (see FileConfiguration.file_key) is unchanged. Configs
+    containing values marshal can't store, such as YAML dates, aren't
+    cached.
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+
+    def filename(self, path):
+        if not isinstance(path, six.binary_type):
+            path = path.encode('utf-8')
+        digest = hashlib.sha1(path).hexdigest()
+        return os.path.join(self.directory, '%s.marshal' % digest)
+
+    def get(self, path, key):
+        '''
+        Returns the cached config for path, or None if there is no cached
+        config for this version of the file.
+        '''
+        try:
+            with open(self.filename(path), 'rb') as fd:
+                version, cached_path, cached_key, config = marshal.load(fd)
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return None
+        if (version, cached_path, cached_key) != (CACHE_VERSION, path, key):
+            return None
+        return config
+
+    def put(self, path, key, config):
+        '''
+        Store config as the parsed version of path. Failures are ignored,
+        since the cache is only an optimization.
+        '''
+        filename = self.filename(path)
+        tmpname = '%s.%d.tmp' % (filename, os.getpid())
+        try:
+            data = marshal.dumps((CACHE_VERSION, path, key, config))
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            with open(tmpname, 'wb') as fd:
+                fd.write(data)
+            os.rename(tmpname, filename)
+        except (IOError, OSError, ValueError):
+            try:
+                os.unlink(tmpname)
+            except OSError:
+                pass
 
 
 class FileConfiguration(Configuration):
+    def __init__(self):
+        Configuration.__init__(self)
+        # Maps each loaded path to (file_key(path), parsed config)
+        self.parsed = {}
+        self.cache = None
+        if os.environ.get('CLAY_CONFIG_CACHE_DIR'):
+            self.cache = ConfigCache(os.environ['CLAY_CONFIG_CACHE_DIR'])
+
+    def get_paths(self):
+        '''
+        Returns the absolute paths of the config files to load, in the order
+        they should be merged.
+        '''
+        paths = list(self.paths)
+
+        if 'CLAY_CONFIG' in os.environ:
+            paths += os.environ['CLAY_CONFIG'].split(':')
+
+        return [os.path.abspath(os.path.expandvars(path)) for path in paths]
+
+    def file_key(self, path):
+        '''
+        Returns a value that changes whenever the file at path is modified or
+        replaced.
+        '''
+        st = os.stat(path)
+        return (st.st_ino, st.st_size, st.st_mtime)
+
     def load(self, signum=None, frame=None):
         '''
         Iterate through expected config file paths, loading the ones that
@@ -125,24 +506,97 @@ class FileConfiguration(Configuration):
         if not cwd in sys.path:
             sys.path.insert(0, cwd)
 
-        self.config = {}
-        paths = list(self.paths)
+        config = ConfigDict()
+        parsed = {}
+        for path in self.get_paths():
+            key = self.file_key(path)
+            parsed[path] = (key, self.load_from_file(path))
+            config.update(parsed[path][1])
 
-        if 'CLAY_CONFIG' in os.environ:
-            paths += os.environ['CLAY_CONFIG'].split(':')
+        # The new configuration is built completely before it replaces the
+        # old one, so concurrent readers never see a partial configuration.
+        self.publish(config, time.time())
+        self.parsed = parsed
 
+        self.init_logging()
+        log_config = self.get('logging')
+        if log_config:
+            self.configure_logging(log_config)
+
+    def reload(self):
+        '''
+        Reload the configuration, parsing only the files that have changed
+        since they were last loaded. Logging is only reconfigured if the
+        logging section changed. Unlike load(), errors are logged and the
+        current configuration is kept. Returns True if the configuration was
+        reloaded.
+        '''
+        log = self.get_logger('clay.config')
+
+        paths = self.get_paths()
+        changed = (set(paths) != set(self.parsed))
+        parsed = {}
+        try:
+            for path in paths:
+                key = self.file_key(path)
+                if path in self.parsed and self.parsed[path][0] == key:
+                    parsed[path] = self.parsed[path]
+                else:
+                    parsed[path] = (key, self.parse_file(path))
+                    changed = True
+        except Exception as e:
+            log.error('Error reloading config from %s: %s' % (path, str(e)))
+            return False
+
+        if not changed:
+            return False
+
+        config = ConfigDict()
         for path in paths:
-            path = os.path.expandvars(path)
-            path = os.path.abspath(path)
-            config = self.load_from_file(path)
-            self.config.update(config)
+            config.update(parsed[path][1])
 
-        self.last_updated = time.time()
+        old_log_config = self.get('logging')
+        self.publish(config, time.time())
+        self.parsed = parsed
 
-        self.init_logging()
         log_config = self.get('logging')
-        if log_config:
+        if log_config and log_config != old_log_config:
+            self.init_logging()
             self.configure_logging(log_config)
+        return True
+
+    def parse_file(self, filename):
+        '''
+        Parse the configuration in the given filename. Raises ValueError if
+        the file can't be parsed or is empty.
+        '''
+        log = self.get_logger('clay.config')
+
+        if self.cache is not None:
+            key = self.file_key(filename)
+            config = self.cache.get(filename, key)
+            if config is not None:
+                log.info('Loaded cached configuration for %s' % filename)
+                return config
+
+        filetype = os.path.splitext(filename)[-1].lstrip('.').lower()
+        if not filetype in SERIALIZERS:
+            log.warning('Unknown config format %s, parsing as JSON' % filetype)
+            filetype = 'json'
+
+        # Try getting a safe_load function. If absent, use 'load'.
+        load = getattr(SERIALIZERS[filetype], "safe_load",
+                       getattr(SERIALIZERS[filetype], "load"))
+
+        with file(filename, 'r') as fd:
+            config = load(fd)
+        if not config:
+            raise ValueError('Empty config')
+        log.info('Loaded configuration from %s' % filename)
+
+        if self.cache is not None:
+            self.cache.put(filename, key, config)
+        return config
 
     def load_from_file(self, filename):
         '''
@@ -152,20 +606,7 @@ class FileConfiguration(Configuration):
         log = self.get_logger('clay.config')
 
         try:
-            filetype = os.path.splitext(filename)[-1].lstrip('.').lower()
-            if not filetype in SERIALIZERS:
-                log.warning('Unknown config format %s, parsing as JSON' % filetype)
-                filetype = 'json'
-
-            # Try getting a safe_load function. If absent, use 'load'.
-            load = getattr(SERIALIZERS[filetype], "safe_load",
-                           getattr(SERIALIZERS[filetype], "load"))
-
-            config = load(file(filename, 'r'))
-            if not config:
-                raise ValueError('Empty config')
-            log.info('Loaded configuration from %s' % filename)
-            return config
+            return self.parse_file(filename)
         except ValueError as e:
             log.critical('Error loading config from %s: %s' %
                 (filename, str(e)))
@@ -173,6 +614,137 @@ class FileConfiguration(Configuration):
             return {}
 
 
+class Inotify(object):
+    '''
+    Minimal ctypes wrapper around the Linux inotify API, reporting the names
+    of files that are closed after writing, created, moved or deleted in the
+    watched directories. Individual writes (IN_MODIFY) aren't watched, so
+    that half written files aren't reloaded.
+    '''
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    MASK = (IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+            IN_MOVED_FROM)
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self, libc, fd):
+        self.libc = libc
+        self.fd = fd
+
+    @classmethod
+    def create(cls):
+        '''
+        Returns a new Inotify instance, or None if inotify is not available
+        on this platform.
+        '''
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK)
+        except (OSError, AttributeError):
+            return None
+        if fd < 0:
+            return None
+        return cls(libc, fd)
+
+    def watch(self, directory):
+        wd = self.libc.inotify_add_watch(self.fd, directory.encode('utf-8'), self.MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), directory)
+
+    def read(self, timeout):
+        '''
+        Waits up to timeout seconds for events and returns the set of file
+        names they refer to.
+        '''
+        names = set()
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return names
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    break
+                raise
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = self.EVENT.unpack_from(data, offset)
+                offset += self.EVENT.size
+                names.add(data[offset:offset + length].rstrip(b'\0').decode('utf-8'))
+                offset += length
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+class ConfigWatcher(object):
+    '''
+    Reloads a FileConfiguration from a background thread whenever the files
+    it was loaded from change, using inotify where available and checking
+    file modification times every interval seconds otherwise. Only changed
+    files are parsed again.
+    '''
+    def __init__(self, configuration, interval=WATCH_INTERVAL, use_inotify=True):
+        self.configuration = configuration
+        self.interval = interval
+        self.use_inotify = use_inotify
+        self.inotify = None
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        log = self.configuration.get_logger('clay.config')
+        paths = self.configuration.get_paths()
+        self.names = set(os.path.basename(path) for path in paths)
+
+        if self.use_inotify:
+            self.inotify = Inotify.create()
+        if self.inotify is not None:
+            try:
+                # Directories are watched rather than the files themselves so
+                # that files replaced by a rename are still noticed.
+                for directory in set(os.path.dirname(path) for path in paths):
+                    self.inotify.watch(directory)
+            except OSError as e:
+                log.warning('Unable to watch config with inotify, polling instead: %s' % str(e))
+                self.inotify.close()
+                self.inotify = None
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def run(self):
+        log = self.configuration.get_logger('clay.config')
+        while not self.stopped.is_set():
+            if self.inotify is not None:
+                if not (self.inotify.read(self.interval) & self.names):
+                    continue
+            else:
+                self.stopped.wait(self.interval)
+            if self.stopped.is_set():
+                break
+            try:
+                if self.configuration.reload():
+                    log.info('Reloaded changed configuration')
+            except Exception:
+                log.exception('Error reloading configuration')
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+
+
 CONFIG = FileConfiguration()
 CONFIG.load()
 
@@ -183,4 +755,12 @@ signal.signal(signal.SIGHUP, CONFIG.load)
 get = CONFIG.get
 get_logger = CONFIG.get_logger
 feature_flag = CONFIG.feature_flag
+feature_flags = CONFIG.feature_flags
+snapshot = CONFIG.snapshot
 debug = CONFIG.debug
+
+# Optionally reload the configuration whenever its files change
+watcher = None
+if get('config.watch', False):
+    watcher = ConfigWatcher(CONFIG, get('config.watch_interval', WATCH_INTERVAL))
+    watcher.start()
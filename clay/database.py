@@ -1,38 +1,852 @@
-from clay import config
+from clay import config, stats
+from collections import OrderedDict
+import functools
+import itertools
 import threading
 import random
+import time
+import sys
+import re
+
+import six
 
 log = config.get_logger('clay.database')
 
+# Weight of each new sample in a server's moving average latency
+LATENCY_EWMA_WEIGHT = 0.2
+
+# Seconds a server is avoided after failing to connect, doubling with each
+# consecutive failure up to MAX_FAILURE_COOLDOWN
+FAILURE_COOLDOWN = 5.0
+MAX_FAILURE_COOLDOWN = 60.0
+
+# Default number of rows fetched or inserted at a time by stream() and
+# bulk_insert()
+BATCH_SIZE = 1000
+
+# Patterns replaced with ? when normalizing SQL for the slow query log
+SQL_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+SQL_IN_LISTS = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+SQL_WHITESPACE = re.compile(r'\s+')
+
+# Statements that PostgreSQL can prepare, and psycopg2's placeholders
+SQL_PREPARABLE = re.compile(r'^\s*(SELECT|INSERT|UPDATE|DELETE|WITH|VALUES)\b', re.IGNORECASE)
+SQL_PLACEHOLDERS = re.compile(r'%[s%]')
+
+
+def ewma(average, sample):
+    '''
+    Returns the exponentially weighted moving average updated with sample
+    '''
+    if average is None:
+        return sample
+    return average + LATENCY_EWMA_WEIGHT * (sample - average)
+
+
+def normalize_sql(sql):
+    '''
+    Returns sql with literals replaced by ? and whitespace collapsed, so that
+    queries that only differ in their arguments look the same.
+    '''
+    sql = SQL_LITERALS.sub('?', sql)
+    sql = SQL_IN_LISTS.sub('(?)', sql)
+    return SQL_WHITESPACE.sub(' ', sql).strip()
+
+
+class Instrumentation(object):
+    '''
+    Stats handles and slow query logging for a DatabaseContext. Timings are
+    reported in milliseconds under <stats_prefix>.<name>.
+    '''
+    def __init__(self, name, stats_prefix='clay.database', slow_query_ms=None):
+        prefix = '%s.%s' % (stats_prefix, name)
+        self.connect = stats.timer('%s.connect' % prefix)
+        self.checkout_wait = stats.timer('%s.checkout_wait' % prefix)
+        self.execute = stats.timer('%s.execute' % prefix)
+        self.rows = stats.counter('%s.rows' % prefix)
+        self.slow_queries = stats.counter('%s.slow_queries' % prefix)
+        self.slow_query_ms = slow_query_ms
+
+    def record_query(self, sql, ms):
+        self.execute.record(ms)
+        if self.slow_query_ms is not None and ms >= self.slow_query_ms:
+            self.slow_queries.incr()
+            log.warning('Slow query (%.1fms): %s' % (ms, normalize_sql(sql)))
+
+
+class InstrumentedCursor(object):
+    '''
+    Wraps a DB-API cursor, recording the time taken by each statement and
+    the number of rows fetched. Rows are counted on the cursor and reported
+    once per result set: when the results run out, the next statement is
+    executed or the cursor is closed.
+    '''
+    def __init__(self, cursor, instrumentation, health):
+        self.cursor = cursor
+        self.instrumentation = instrumentation
+        self.health = health
+        self.rows = 0
+
+    def report_rows(self):
+        if self.rows:
+            self.instrumentation.rows.incr(self.rows)
+            self.rows = 0
+
+    def timed(self, method, sql, args):
+        self.report_rows()
+        start = time.time()
+        try:
+            return method(sql, *args)
+        finally:
+            elapsed = time.time() - start
+            self.health.record_latency(elapsed)
+            self.instrumentation.record_query(sql, elapsed * 1000.0)
+
+    def execute(self, sql, *args):
+        return self.timed(self.cursor.execute, sql, args)
+
+    def executemany(self, sql, *args):
+        return self.timed(self.cursor.executemany, sql, args)
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        if row is None:
+            self.report_rows()
+        else:
+            self.rows += 1
+        return row
+
+    def fetchmany(self, *args):
+        rows = self.cursor.fetchmany(*args)
+        if rows:
+            self.rows += len(rows)
+        else:
+            self.report_rows()
+        return rows
+
+    def fetchall(self):
+        rows = self.cursor.fetchall()
+        self.rows += len(rows)
+        self.report_rows()
+        return rows
+
+    def __iter__(self):
+        try:
+            for row in self.cursor:
+                self.rows += 1
+                yield row
+        finally:
+            self.report_rows()
+
+    def close(self):
+        self.report_rows()
+        return self.cursor.close()
+
+    def __enter__(self):
+        self.cursor.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.report_rows()
+        return self.cursor.__exit__(exc_type, exc_value, exc_traceback)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __setattr__(self, name, value):
+        if name in ('cursor', 'instrumentation', 'health', 'rows'):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self.cursor, name, value)
+
+
+class InstrumentedConnection(object):
+    '''
+    Wraps a DB-API connection so that its cursors are instrumented
+    '''
+    def __init__(self, connection, instrumentation, health):
+        self.connection = connection
+        self.instrumentation = instrumentation
+        self.health = health
+
+    def cursor(self, *args, **kwargs):
+        return InstrumentedCursor(self.connection.cursor(*args, **kwargs),
+                                  self.instrumentation, self.health)
+
+    def __enter__(self):
+        self.connection.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        return self.connection.__exit__(exc_type, exc_value, exc_traceback)
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    def __setattr__(self, name, value):
+        if name in ('connection', 'instrumentation', 'health'):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self.connection, name, value)
+
+
+class PoolTimeout(Exception):
+    '''
+    Raised when no connection could be checked out of a ConnectionPool
+    before the checkout timeout expired.
+    '''
+    pass
+
+
+class StatementCache(object):
+    '''
+    Least recently used cache of the server side prepared statements on a
+    single psycopg2 connection, keyed by SQL. Only statements with
+    positional %s placeholders are prepared. Statements the server refuses
+    to prepare are remembered so that they're run unprepared from then on.
+    '''
+    def __init__(self, size):
+        self.size = size
+        self.statements = OrderedDict()
+        self.ids = itertools.count()
+
+    def lookup(self, cursor, sql, nparams):
+        '''
+        Returns an EXECUTE statement to run in place of sql, preparing it on
+        the connection first if it isn't cached, or None if sql can't be
+        prepared.
+        '''
+        cached = self.statements.pop(sql, None)
+        if cached is None:
+            if '%(' in sql or not SQL_PREPARABLE.match(sql):
+                return None
+            placeholders = [m for m in SQL_PLACEHOLDERS.findall(sql) if m == '%s']
+            if len(placeholders) != nparams:
+                return None
+
+            numbers = itertools.count(1)
+            body = SQL_PLACEHOLDERS.sub(
+                lambda m: '%' if m.group(0) == '%%' else '$%d' % next(numbers), sql)
+            name = 'clay_stmt_%d' % next(self.ids)
+            if self.prepare(cursor, name, body):
+                if nparams:
+                    statement = 'EXECUTE %s (%s)' % (name, ', '.join(['%s'] * nparams))
+                else:
+                    statement = 'EXECUTE %s' % name
+                cached = (name, statement)
+            else:
+                cached = (None, None)
+
+            while len(self.statements) >= self.size:
+                old_sql, (old_name, old_statement) = self.statements.popitem(last=False)
+                if old_name is not None:
+                    cursor.execute('DEALLOCATE %s' % old_name)
+        self.statements[sql] = cached
+        return cached[1]
+
+    def prepare(self, cursor, name, body):
+        '''
+        Prepares body as name, returning False if the server refuses. Inside
+        a transaction, this is done in a savepoint so that a failed PREPARE
+        doesn't abort the transaction.
+        '''
+        savepoint = not cursor.connection.autocommit
+        if savepoint:
+            cursor.execute('SAVEPOINT clay_prepare')
+        try:
+            cursor.execute('PREPARE %s AS %s' % (name, body))
+        except Exception as e:
+            log.warning('Unable to prepare statement %s: %s' % (body, str(e)))
+            if savepoint:
+                cursor.execute('ROLLBACK TO SAVEPOINT clay_prepare')
+            return False
+        if savepoint:
+            cursor.execute('RELEASE SAVEPOINT clay_prepare')
+        return True
+
+
+class PreparedCursor(object):
+    '''
+    Wraps a psycopg2 cursor, running statements through a StatementCache.
+    Statements with a list, tuple or dict parameter aren't prepared, since
+    psycopg2 adapts those into SQL syntax (IN lists, ARRAY[...], hstore)
+    which can't be bound to a single typed PREPARE parameter.
+    '''
+    def __init__(self, cursor, statements):
+        self.cursor = cursor
+        self.statements = statements
+
+    @staticmethod
+    def preparable(params):
+        return isinstance(params, (list, tuple)) and \
+            not any(isinstance(param, (list, tuple, dict)) for param in params)
+
+    def execute(self, sql, params=None):
+        if self.preparable(params):
+            statement = self.statements.lookup(self.cursor, sql, len(params))
+            if statement is not None:
+                return self.cursor.execute(statement, params)
+        return self.cursor.execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        seq_of_params = list(seq_of_params)
+        if seq_of_params and all(self.preparable(params) for params in seq_of_params):
+            statement = self.statements.lookup(self.cursor, sql, len(seq_of_params[0]))
+            if statement is not None:
+                return self.cursor.executemany(statement, seq_of_params)
+        return self.cursor.executemany(sql, seq_of_params)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __enter__(self):
+        self.cursor.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        return self.cursor.__exit__(exc_type, exc_value, exc_traceback)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __setattr__(self, name, value):
+        if name in ('cursor', 'statements'):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self.cursor, name, value)
+
+
+class PreparedConnection(object):
+    '''
+    Wraps a psycopg2 connection so that its cursors use prepared statements
+    '''
+    def __init__(self, connection, statements):
+        self.connection = connection
+        self.statements = statements
+
+    def cursor(self, *args, **kwargs):
+        cursor = self.connection.cursor(*args, **kwargs)
+        if args or kwargs.get('name'):
+            # Named (server side) cursors can't DECLARE an EXECUTE
+            return cursor
+        return PreparedCursor(cursor, self.statements)
+
+    def __enter__(self):
+        self.connection.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        return self.connection.__exit__(exc_type, exc_value, exc_traceback)
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    def __setattr__(self, name, value):
+        if name in ('connection', 'statements'):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self.connection, name, value)
+
+
+class PooledConnection(object):
+    '''
+    A connection owned by a ConnectionPool and the times it was opened and
+    last returned to the pool, and the statements prepared on it.
+    '''
+    def __init__(self, connection):
+        self.connection = connection
+        self.created = time.time()
+        self.last_used = self.created
+        self.statements = None
+
+    def close(self):
+        try:
+            self.connection.close()
+        except Exception:
+            log.exception('Error closing pooled database connection')
+
+
+class ConnectionPool(object):
+    '''
+    A thread safe, bounded pool of connections to a single database server.
+    connect is called with no arguments to open a new connection.
+    '''
+    def __init__(self, connect, min_size=0, max_size=10, idle_timeout=300.0,
+                 max_lifetime=3600.0, checkout_timeout=5.0,
+                 health_check_interval=5.0):
+        '''
+        Up to max_size connections are open at once. Idle connections are
+        closed after idle_timeout seconds unless that would leave fewer than
+        min_size open, and every connection is closed once it is older than
+        max_lifetime seconds. A connection that has been idle for longer
+        than health_check_interval seconds is checked with a trivial query
+        before it is handed out. checkout() waits up to checkout_timeout
+        seconds for a connection when the pool is exhausted.
+        '''
+        self.connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.checkout_timeout = checkout_timeout
+        self.health_check_interval = health_check_interval
+
+        self.lock = threading.Condition()
+        # Most recently used last, so that surplus connections go idle
+        self.idle = []
+        self.size = 0
+
+    def expired(self, pooled, now):
+        return (now - pooled.created) >= self.max_lifetime
+
+    def prune(self, now):
+        '''
+        Removes idle connections that have expired or been idle for too long
+        and returns them. Must be called with the lock held.
+        '''
+        keep = []
+        removed = []
+        for pooled in self.idle:
+            if self.expired(pooled, now):
+                removed.append(pooled)
+            elif (now - pooled.last_used) >= self.idle_timeout and \
+                    self.size - len(removed) > self.min_size:
+                removed.append(pooled)
+            else:
+                keep.append(pooled)
+        self.idle = keep
+        self.size -= len(removed)
+        return removed
+
+    def healthy(self, pooled):
+        '''
+        Returns True if a trivial query succeeds on the connection
+        '''
+        try:
+            cur = pooled.connection.cursor()
+            try:
+                cur.execute('SELECT 1')
+                cur.fetchall()
+            finally:
+                cur.close()
+            return True
+        except Exception as e:
+            log.warning('Discarding unhealthy database connection: %s' % str(e))
+            return False
+
+    def checkout(self, timeout=None):
+        '''
+        Returns a PooledConnection, opening a new connection if none are idle
+        and the pool isn't full. Raises PoolTimeout if no connection becomes
+        available within timeout (or checkout_timeout) seconds.
+        '''
+        if timeout is None:
+            timeout = self.checkout_timeout
+        deadline = time.time() + timeout
+
+        while True:
+            pooled = None
+            removed = []
+            try:
+                with self.lock:
+                    while True:
+                        now = time.time()
+                        removed.extend(self.prune(now))
+                        if self.idle:
+                            pooled = self.idle.pop()
+                            break
+                        if self.size < self.max_size:
+                            self.size += 1
+                            break
+                        if now >= deadline:
+                            raise PoolTimeout('Timed out waiting %.1fs for a database connection' % timeout)
+                        self.lock.wait(deadline - now)
+            finally:
+                for old in removed:
+                    old.close()
+
+            if pooled is None:
+                try:
+                    return PooledConnection(self.connect())
+                except Exception:
+                    self.discard(None)
+                    raise
+
+            if (now - pooled.last_used) < self.health_check_interval or self.healthy(pooled):
+                return pooled
+            self.discard(pooled)
+
+    def checkin(self, pooled):
+        '''
+        Returns a connection to the pool. The caller is responsible for
+        ending any open transaction first.
+        '''
+        now = time.time()
+        if self.expired(pooled, now):
+            self.discard(pooled)
+            return
+        pooled.last_used = now
+        with self.lock:
+            self.idle.append(pooled)
+            self.lock.notify()
+
+    def discard(self, pooled):
+        '''
+        Closes a checked out connection instead of returning it to the pool
+        '''
+        with self.lock:
+            self.size -= 1
+            self.lock.notify()
+        if pooled is not None:
+            pooled.close()
+
+    def close(self):
+        '''
+        Closes all idle connections
+        '''
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+            self.size -= len(idle)
+            self.lock.notify_all()
+        for pooled in idle:
+            pooled.close()
+
+
+class ServerHealth(object):
+    '''
+    Tracks connection failures and moving averages of the query, connect and
+    pool checkout latency of a single database server, and its ConnectionPool
+    if pooling is enabled.
+    '''
+    def __init__(self, server, cooldown=FAILURE_COOLDOWN, max_cooldown=MAX_FAILURE_COOLDOWN):
+        self.server = server
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.pool = None
+        self.latency = None
+        self.connect_latency = None
+        self.checkout_latency = None
+        self.failures = 0
+        self.retry_at = 0
+
+    def available(self, now):
+        return now >= self.retry_at
+
+    def score(self):
+        '''
+        Lower is better: query latency, or connect latency until there are
+        query samples, plus any time spent waiting for a pooled connection.
+        Servers without latency samples and servers that are due to be probed
+        after failing score best, so that they're tried.
+        '''
+        latency = self.latency
+        if latency is None:
+            latency = self.connect_latency
+        if self.failures or latency is None:
+            return 0.0
+        return latency + (self.checkout_latency or 0.0)
+
+    def record_latency(self, seconds):
+        self.latency = ewma(self.latency, seconds)
+
+    def record_connect(self, seconds):
+        self.connect_latency = ewma(self.connect_latency, seconds)
+
+    def record_checkout(self, seconds):
+        self.checkout_latency = ewma(self.checkout_latency, seconds)
+
+    def record_success(self):
+        self.failures = 0
+        self.retry_at = 0
+
+    def record_failure(self, now):
+        self.failures += 1
+        cooldown = self.cooldown * (2 ** min(self.failures - 1, 16))
+        self.retry_at = now + min(cooldown, self.max_cooldown)
+
 
 class DatabaseContext(object):
-    def __init__(self, servers, dbapi_name):
+    def __init__(self, servers, dbapi_name, pool=None,
+                 cooldown=FAILURE_COOLDOWN, max_cooldown=MAX_FAILURE_COOLDOWN,
+                 name='db', instrument=None, statement_cache=None):
         '''
-        Servers is a list of config dicts for connecting to postgres
+        Servers is a list of config dicts for connecting to postgres. If pool
+        is a dict of ConnectionPool options, connections are kept open in a
+        pool for each server instead of being opened and closed every time
+        the context manager is used.
+
+        Servers that fail to connect are avoided for cooldown seconds,
+        doubling up to max_cooldown while they keep failing, and then probed
+        again. Otherwise, the faster of two randomly chosen servers is used
+        (see ServerHealth.score). Query latency is sampled from instrumented
+        statements and from the rollback that returns a pooled connection.
+
+        If instrument is a dict of Instrumentation options, connection and
+        query timings are reported through clay.stats under the given name.
+
+        If statement_cache is set, up to that many statements are kept
+        prepared on each connection: with server side prepared statements
+        for psycopg2, and with sqlite3's own statement cache. MySQLdb has no
+        prepared statement support, so the option has no effect there.
         '''
         self.servers = servers
+        self.lock = threading.Lock()
+        self.health = [ServerHealth(server, cooldown, max_cooldown) for server in servers]
 
+        # Each thread's connection and how many with blocks are using it.
+        # Attributes are only set on threads that have entered the context.
         self.tlocal = threading.local()
-        self.tlocal.dbconn = None
 
         if not dbapi_name in ('psycopg2', 'MySQLdb', 'sqlite3'):
             raise NotImplementedError('Unsupported database module: %s' % dbapi_name)
         self.dbapi_name = dbapi_name
         self.dbapi = __import__(dbapi_name)
 
-    def __enter__(self):
-        server = random.choice(self.servers)
+        self.instrumentation = None
+        if instrument:
+            self.instrumentation = Instrumentation(name, **instrument)
+
+        self.statement_cache = statement_cache
+        self.cursor_ids = itertools.count()
+        self.pooled = bool(pool)
+        if pool:
+            for health in self.health:
+                health.pool = ConnectionPool(functools.partial(self.connect, health), **pool)
+
+    def choose(self, exclude=()):
+        '''
+        Returns the ServerHealth of the server to connect to next, or None if
+        every server is excluded. Of the servers that aren't cooling down
+        after a failure, the one with the lower score of two random choices
+        is picked. If all servers are cooling down, the one that will be
+        available soonest is picked.
+        '''
+        now = time.time()
+        with self.lock:
+            candidates = [h for h in self.health if h not in exclude]
+            if not candidates:
+                return None
+            available = [h for h in candidates if h.available(now)]
+            if not available:
+                available = [min(candidates, key=lambda h: h.retry_at)]
+
+            if len(available) == 1:
+                health = available[0]
+            else:
+                first, second = random.sample(available, 2)
+                health = first if first.score() <= second.score() else second
+
+            if health.failures:
+                # Only one thread at a time probes a failing server
+                health.retry_at = now + health.cooldown
+        return health
+
+    def connect(self, health):
+        '''
+        Open a new connection to the given server, recording its latency
+        '''
+        server = health.server
+        if self.pooled and self.dbapi_name == 'sqlite3':
+            # Pooled connections may be used by a different thread each time
+            server = dict(server, check_same_thread=False)
+        if self.statement_cache and self.dbapi_name == 'sqlite3':
+            server = dict(server, cached_statements=self.statement_cache)
+        start = time.time()
         conn = self.dbapi.connect(**server)
-        self.tlocal.dbconn = conn
+        elapsed = time.time() - start
+        health.record_connect(elapsed)
+        if self.instrumentation is not None:
+            self.instrumentation.connect.record(elapsed * 1000.0)
         return conn
 
+    def open(self):
+        '''
+        Returns a (ServerHealth, PooledConnection or None, connection) tuple,
+        failing over to other servers if connecting to the chosen one fails.
+        '''
+        tried = []
+        exc_info = None
+        while True:
+            health = self.choose(tried)
+            if health is None:
+                six.reraise(*exc_info)
+            tried.append(health)
+
+            try:
+                if health.pool is not None:
+                    start = time.time()
+                    pooled = health.pool.checkout()
+                    elapsed = time.time() - start
+                    health.record_checkout(elapsed)
+                    if self.instrumentation is not None:
+                        self.instrumentation.checkout_wait.record(elapsed * 1000.0)
+                    conn = pooled.connection
+                else:
+                    pooled = None
+                    conn = self.connect(health)
+            except self.dbapi.Error as e:
+                exc_info = sys.exc_info()
+                health.record_failure(time.time())
+                log.warning('Unable to connect to database %s: %s' % (
+                    health.server.get('host', health.server.get('database')), str(e)))
+                continue
+
+            health.record_success()
+            return health, pooled, conn
+
+    @property
+    def dbconn(self):
+        '''
+        The connection in use by the current thread, or None
+        '''
+        return getattr(self.tlocal, 'dbconn', None)
+
+    def __enter__(self):
+        '''
+        Returns a connection for use by the current thread. If the thread is
+        already inside a with block for this context, the same connection is
+        returned again instead of opening another one.
+        '''
+        depth = getattr(self.tlocal, 'depth', 0)
+        if depth:
+            self.tlocal.depth = depth + 1
+            return self.tlocal.wrapped
+
+        health, pooled, conn = self.open()
+        wrapped = conn
+        if self.statement_cache and self.dbapi_name == 'psycopg2':
+            if pooled is None:
+                statements = StatementCache(self.statement_cache)
+            else:
+                if pooled.statements is None:
+                    pooled.statements = StatementCache(self.statement_cache)
+                statements = pooled.statements
+            wrapped = PreparedConnection(wrapped, statements)
+        if self.instrumentation is not None:
+            wrapped = InstrumentedConnection(wrapped, self.instrumentation, health)
+        self.tlocal.health = health
+        self.tlocal.pooled = pooled
+        self.tlocal.dbconn = conn
+        self.tlocal.wrapped = wrapped
+        self.tlocal.depth = 1
+        return wrapped
+
     def __exit__(self, exc_type, exc_value, exc_traceback):
-        self.tlocal.dbconn.close()
-        self.tlocal.dbconn = None
+        self.tlocal.depth -= 1
+        if self.tlocal.depth:
+            return False
+
+        try:
+            if self.pooled:
+                self.release(exc_type)
+            else:
+                self.tlocal.dbconn.close()
+        finally:
+            self.tlocal.dbconn = None
+            self.tlocal.wrapped = None
+            self.tlocal.health = None
+        return False
+
+    def release(self, exc_type):
+        '''
+        Roll back anything left uncommitted and return the thread's pooled
+        connection to its pool, or close it if it may be broken.
+        '''
+        pool = self.tlocal.health.pool
+        pooled = self.tlocal.pooled
+        self.tlocal.pooled = None
+
+        broken = exc_type is not None and \
+            issubclass(exc_type, (self.dbapi.OperationalError, self.dbapi.InterfaceError))
+        if not broken:
+            try:
+                # A round trip to the server even without instrumentation,
+                # so it doubles as a query latency sample
+                start = time.time()
+                pooled.connection.rollback()
+                self.tlocal.health.record_latency(time.time() - start)
+            except Exception:
+                log.exception('Error rolling back pooled database connection')
+                broken = True
+
+        if broken:
+            pool.discard(pooled)
+        else:
+            pool.checkin(pooled)
+
+    def server_cursor(self, conn, batch_size):
+        '''
+        Returns a cursor which leaves the result set on the server and
+        fetches it as it is read, rather than loading it into memory all at
+        once.
+        '''
+        if self.dbapi_name == 'psycopg2':
+            # Named cursors are server side, and must be unique per connection
+            cur = conn.cursor(name='clay_stream_%d' % next(self.cursor_ids))
+            cur.itersize = batch_size
+            return cur
+        if self.dbapi_name == 'MySQLdb':
+            import MySQLdb.cursors
+            return conn.cursor(MySQLdb.cursors.SSCursor)
+        # sqlite3 cursors already step through results as they're fetched
+        return conn.cursor()
+
+    def stream_batches(self, sql, params=None, batch_size=BATCH_SIZE):
+        '''
+        Generator running the given query with a server side cursor and
+        yielding lists of up to batch_size rows, so that memory use doesn't
+        depend on the size of the result. The connection is held until the
+        generator is exhausted or closed. With MySQLdb, no other queries may
+        be run on the connection in the meantime.
+        '''
+        with self as conn:
+            cur = self.server_cursor(conn, batch_size)
+            try:
+                if params is None:
+                    cur.execute(sql)
+                else:
+                    cur.execute(sql, params)
+                while True:
+                    rows = cur.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    yield rows
+            finally:
+                cur.close()
+
+    def stream(self, sql, params=None, batch_size=BATCH_SIZE):
+        '''
+        Generator yielding each row of the given query, fetched in batches
+        by stream_batches()
+        '''
+        for rows in self.stream_batches(sql, params, batch_size):
+            for row in rows:
+                yield row
+
+    def bulk_insert(self, sql, rows, chunk_size=BATCH_SIZE, commit=True):
+        '''
+        Runs executemany() for the given statement over rows, which may be
+        any iterable, chunk_size rows at a time. Commits once all rows have
+        been inserted unless commit is False. Returns the number of rows.
+        '''
+        rows = iter(rows)
+        count = 0
+        with self as conn:
+            cur = conn.cursor()
+            try:
+                while True:
+                    chunk = list(itertools.islice(rows, chunk_size))
+                    if not chunk:
+                        break
+                    cur.executemany(sql, chunk)
+                    count += len(chunk)
+            finally:
+                cur.close()
+            if commit:
+                conn.commit()
+        return count
 
-        if exc_type is not None:
-            raise
-    
     def __str__(self):
         if self.dbconn is not None:
             return 'DatabaseContext %s %r (connected)' % (self.dbapi_name, self.servers)
@@ -40,5 +854,11 @@ class DatabaseContext(object):
             return 'DatabaseContext %s %r (not connected)' % (self.dbapi_name, self.servers)
 
 
-read = DatabaseContext(config.get('database.read'), config.get('database.module'))
-write = DatabaseContext(config.get('database.write'), config.get('database.module'))
+read = DatabaseContext(config.get('database.read'), config.get('database.module'),
+                       pool=config.get('database.pool'), name='read',
+                       instrument=config.get('database.instrument'),
+                       statement_cache=config.get('database.statement_cache'))
+write = DatabaseContext(config.get('database.write'), config.get('database.module'),
+                        pool=config.get('database.pool'), name='write',
+                        instrument=config.get('database.instrument'),
+                        statement_cache=config.get('database.statement_cache'))
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+'''
+Per-host log forwarder. Worker processes log through clay.logger.UnixHandler
+to a local Unix datagram socket; this process batches the records and sends
+them upstream over a single clay.logger.TCPHandler connection, rather than
+every worker holding its own TLS connection to the log server.
+
+Configured by the logforwarder section of the clay config. "socket" is the
+path to listen on and every other option is passed to TCPHandler.
+
+    {
+        "logforwarder": {
+            "socket": "/var/run/clay/logforwarder.sock",
+            "host": "logs.example.com",
+            "port": 5140,
+            "ssl_ca_file": "/etc/ssl/certs/ca-certificates.crt",
+            "compression": "zlib"
+        }
+    }
+'''
+from __future__ import absolute_import
+import socket
+import stat
+import sys
+import os
+
+from clay import config, logger
+
+log = config.get_logger('clay.logforwarder')
+
+# Large enough for any single record, including long tracebacks
+MAX_DATAGRAM_SIZE = 256 * 1024
+RECEIVE_BUFFER_SIZE = 4 * 1024 * 1024
+
+
+class LogForwarder(object):
+    '''
+    Receives json_events from UnixHandlers on a Unix datagram socket and
+    forwards them to an upstream TCPHandler.
+    '''
+    def __init__(self, path, upstream):
+        self.path = path
+        self.upstream = upstream
+        self.sock = None
+
+    def bind(self):
+        '''
+        Create the socket, replacing a stale socket file left by a previous
+        forwarder.
+        '''
+        if os.path.exists(self.path) and stat.S_ISSOCK(os.stat(self.path).st_mode):
+            os.unlink(self.path)
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER_SIZE)
+        except socket.error:
+            log.warning('Unable to set receive buffer size on %s', self.path)
+        self.sock.bind(self.path)
+        log.info('Forwarding logs from %s to %s:%s', self.path,
+                 self.upstream.host, self.upstream.port)
+
+    def serve_forever(self):
+        if self.sock is None:
+            self.bind()
+        while True:
+            data = self.sock.recv(MAX_DATAGRAM_SIZE)
+            if data:
+                self.upstream.forward(data)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+            os.unlink(self.path)
+        self.upstream.close()
+
+
+def main():
+    '''
+    Run a log forwarder process
+    '''
+    options = dict(config.get('logforwarder', {}))
+    path = options.pop('socket', logger.FORWARDER_SOCKET)
+    if 'host' not in options or 'port' not in options:
+        sys.stderr.write('logforwarder.host and logforwarder.port must be configured\n')
+        return -1
+
+    forwarder = LogForwarder(path, logger.TCPHandler(**options))
+    try:
+        forwarder.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        forwarder.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
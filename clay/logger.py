@@ -1,45 +1,506 @@
 import six
 
-from traceback import format_exc
 from datetime import datetime
-from six.moves.queue import Queue
+from six.moves.queue import Queue, Empty, Full
 
 import threading
 import logging
+import os.path
+import os
 import socket
-import json
+import struct
 import time
+import zlib
 import ssl
 
 
 LOG_QUEUE_SIZE = 5000
+BATCH_RECORDS = 500
+BATCH_BYTES = 256 * 1024
+STATS_INTERVAL = 10.0
+# Seconds UDPHandler.close() waits for queued records to be sent
+CLOSE_TIMEOUT = 2.0
+SPOOL_SEGMENT_BYTES = 16 * 1024 * 1024
+SPOOL_MAX_BYTES = 1024 * 1024 * 1024
+FORWARDER_SOCKET = '/var/run/clay/logforwarder.sock'
+
+# Largest UDP payload that fits in a standard 1500 byte ethernet MTU, used
+# as the default max_payload for queued UDPHandlers
+UDP_MAX_PAYLOAD = 1432
+TRUNCATED_MARKER = '...[truncated]'
+OVERSIZE_TRUNCATE = 'truncate'
+OVERSIZE_DROP = 'drop'
 BACKOFF_INITIAL = 0.1
 BACKOFF_MULTIPLE = 1.2
 INTERNAL_LOG = logging.getLogger('clay_internal')
 
+# Overflow policies applied when the TCPHandler queue is full
+DROP_NEWEST = 'drop_newest'
+DROP_OLDEST = 'drop_oldest'
+DROP_BY_LEVEL = 'drop_by_level'
+OVERFLOW_POLICIES = (DROP_NEWEST, DROP_OLDEST, DROP_BY_LEVEL)
+
+# JSON modules to try, fastest first, if RecordEncoder isn't given one
+JSON_MODULES = ('ujson', 'simplejson', 'json')
+TEMPLATE_CACHE_SIZE = 10000
+
+# Compressed batches are sent as a 4 byte big endian length followed by the
+# compressed newline delimited json_events. See clay.logreceiver.
+FRAME_HEADER = struct.Struct('!I')
+COMPRESSION_WBITS = {
+    'zlib': zlib.MAX_WBITS,
+    'gzip': 16 + zlib.MAX_WBITS,
+}
+
+
+def load_json_module(name=None):
+    '''
+    Import and return the named JSON module, or the first importable module in
+    JSON_MODULES if name is None.
+    '''
+    if name is not None:
+        return __import__(name)
+    for name in JSON_MODULES:
+        try:
+            return __import__(name)
+        except ImportError:
+            pass
+
+
+def compress_frame(data, compression, level=zlib.Z_DEFAULT_COMPRESSION):
+    '''
+    Compress data with zlib or gzip and prefix it with its length.
+    '''
+    compressor = zlib.compressobj(level, zlib.DEFLATED, COMPRESSION_WBITS[compression])
+    payload = compressor.compress(data) + compressor.flush()
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+
+def decompress_frame(payload, compression):
+    '''
+    Decompress the payload of a frame created by compress_frame, without the
+    length prefix.
+    '''
+    return zlib.decompress(payload, COMPRESSION_WBITS[compression])
+
+
+def short_hostname():
+    '''
+    Returns this host's name without the domain
+    '''
+    return socket.gethostname().split('.', 1)[0]
+
+
+class RecordEncoder(object):
+    '''
+    Translates LogRecord instances into json_event strings. Shared by
+    TCPHandler and UDPHandler.
+
+    Everything except the timestamp, message and line number is the same for
+    every record logged from a given call site, so it is encoded once into a
+    template per (logger, level, file, function). The date and time of the
+    current second are also cached. The fastest installed JSON module is used
+    unless json_module names one.
+    '''
+    def __init__(self, hostname=None, json_module=None):
+        if hostname is None:
+            hostname = short_hostname()
+        self.hostname = hostname
+        module = load_json_module(json_module)
+        self.dumps = module.dumps
+        self.encode_string = getattr(getattr(module, 'encoder', None),
+                                     'encode_basestring_ascii', module.dumps)
+        self.formatter = logging.Formatter()
+        self.templates = {}
+        self.second = (None, None)
+
+    def timestamp(self, created):
+        '''
+        Returns the ISO 8601 UTC timestamp of the given time, identical to
+        datetime.utcfromtimestamp(created).isoformat()
+        '''
+        second = int(created)
+        micros = int(round((created - second) * 1e6))
+        if micros >= 1000000:
+            second += 1
+            micros -= 1000000
+
+        cached_second, prefix = self.second
+        if cached_second != second:
+            prefix = datetime.utcfromtimestamp(second).isoformat()
+            self.second = (second, prefix)
+        if micros:
+            return '%s.%06d' % (prefix, micros)
+        return prefix
+
+    def template(self, record):
+        '''
+        Returns a format string for records logged from the same call site as
+        the given record, taking the timestamp, the encoded message and the
+        line number as arguments.
+        '''
+        key = (record.name, record.levelname, record.pathname, record.funcName)
+        template = self.templates.get(key)
+        if template is not None:
+            return template
+
+        def encode(value):
+            return self.dumps(value).replace('%', '%%')
+
+        template = ('{"@source_host": %s, "@timestamp": "%%s", "@tags": %s, '
+                    '"@message": %%s, "@fields": {"level": %s, "filename": %s, '
+                    '"lineno": %%d, "method": %s}}') % (
+            encode(self.hostname), encode([record.name]), encode(record.levelname),
+            encode(record.pathname), encode(record.funcName))
+        if len(self.templates) >= TEMPLATE_CACHE_SIZE:
+            self.templates = {}
+        self.templates[key] = template
+        return template
+
+    def encode(self, record):
+        '''
+        Returns the json_event representation of the given LogRecord
+        '''
+        if record.exc_info:
+            return self.encode_exception(record)
+        return self.template(record) % (
+            self.timestamp(record.created),
+            self.encode_string(record.getMessage()),
+            record.lineno)
+
+    def encode_truncated(self, record, max_size):
+        '''
+        Returns the json_event for the given record with its traceback, exception
+        and then message shortened, so that the event and a trailing newline fit in
+        max_size bytes. Shortened fields end with TRUNCATED_MARKER and the event
+        has a "truncated" field. Returns None if the event can't be made small
+        enough.
+
+        Fields are decoded to unicode before they're cut, so that multibyte
+        characters aren't split, and the longest prefix that fits is found by
+        bisection, since each character may take up to six bytes once escaped.
+        '''
+        values = {'message': record.getMessage()}
+        if record.exc_info:
+            values['exception'] = str(record.exc_info)
+            values['traceback'] = self.formatter.formatException(record.exc_info)
+        for name, value in values.items():
+            if isinstance(value, six.binary_type):
+                values[name] = value.decode('utf-8', 'replace')
+
+        def encode():
+            fields = {
+                'level': record.levelname,
+                'filename': record.pathname,
+                'lineno': record.lineno,
+                'method': record.funcName,
+                'truncated': True,
+            }
+            if record.exc_info:
+                fields['exception'] = values['exception']
+                fields['traceback'] = values['traceback']
+            event = self.dumps({
+                '@source_host': self.hostname,
+                '@timestamp': self.timestamp(record.created),
+                '@tags': [record.name],
+                '@message': values['message'],
+                '@fields': fields,
+            })
+            if isinstance(event, six.text_type):
+                size = len(event.encode('utf-8'))
+            else:
+                size = len(event)
+            if size + 1 <= max_size:
+                return event
+            return None
+
+        event = encode()
+        if event is not None:
+            return event
+
+        for name in ('traceback', 'exception', 'message'):
+            value = values.get(name)
+            if value is None or len(value) <= len(TRUNCATED_MARKER):
+                continue
+            # Longest prefix of the field which, with the marker, fits
+            low, high = 0, len(value) - 1
+            event = None
+            while low <= high:
+                mid = (low + high) // 2
+                values[name] = value[:mid] + TRUNCATED_MARKER
+                candidate = encode()
+                if candidate is None:
+                    high = mid - 1
+                else:
+                    event = candidate
+                    low = mid + 1
+            if event is not None:
+                return event
+            values[name] = TRUNCATED_MARKER
+        return None
+
+    def encode_exception(self, record):
+        fields = {
+            'level': record.levelname,
+            'filename': record.pathname,
+            'lineno': record.lineno,
+            'method': record.funcName,
+            'exception': str(record.exc_info),
+            'traceback': self.formatter.formatException(record.exc_info),
+        }
+        return self.dumps({
+            '@source_host': self.hostname,
+            '@timestamp': self.timestamp(record.created),
+            '@tags': [record.name],
+            '@message': record.getMessage(),
+            '@fields': fields,
+        })
+
+
+class HandlerStats(object):
+    '''
+    Reports a log handler's gauges, counters and timings to clay.stats under
+    the given prefix, at most once every STATS_INTERVAL seconds. Counters are
+    given as running totals and reported as the increase since the last
+    report.
+    '''
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.last_report = 0
+        self.last_counts = {}
+
+    def report(self, gauges=None, counts=None, timings=None):
+        now = time.time()
+        if now - self.last_report < STATS_INTERVAL:
+            return
+        self.last_report = now
+
+        # Imported here because clay.stats imports clay.config, which may be
+        # in the middle of configuring this handler.
+        from clay import stats
+        for name, value in (gauges or {}).items():
+            stats.gauge('%s.%s' % (self.prefix, name), value)
+        for name, value in (counts or {}).items():
+            stats.count('%s.%s' % (self.prefix, name), value - self.last_counts.get(name, 0))
+            self.last_counts[name] = value
+        for name, value in (timings or {}).items():
+            if value is not None:
+                stats.timing('%s.%s' % (self.prefix, name), value)
+
+
+class DiskSpool(object):
+    '''
+    Append-only spool of newline delimited json_events on disk, used by
+    TCPHandler to hold records that cannot be queued in memory while the
+    server is slow or unreachable. Data is written sequentially to numbered
+    segment files of up to segment_bytes each and read back oldest first.
+    When the spool grows beyond max_bytes, the oldest segments are deleted.
+
+    Segments left over from a previous process are read back too, so each
+    handler must be given its own directory.
+    '''
+    SUFFIX = '.spool'
+
+    def __init__(self, directory, segment_bytes=SPOOL_SEGMENT_BYTES,
+                 max_bytes=SPOOL_MAX_BYTES):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.fd = None
+        self.write_segment = None
+        self.read_offset = 0
+
+        self.segments = []
+        self.sizes = {}
+        for name in os.listdir(directory):
+            segment = name[:-len(self.SUFFIX)]
+            if name.endswith(self.SUFFIX) and segment.isdigit():
+                segment = int(segment)
+                self.segments.append(segment)
+                self.sizes[segment] = os.path.getsize(self.path(segment))
+        self.segments.sort()
+        self.size = sum(self.sizes.values())
+
+    def path(self, segment):
+        return os.path.join(self.directory, '%020d%s' % (segment, self.SUFFIX))
+
+    def write(self, data):
+        '''
+        Append newline terminated data to the current segment, starting a new
+        segment if it would grow beyond segment_bytes.
+        '''
+        with self.lock:
+            if self.fd is None or self.sizes[self.write_segment] + len(data) > self.segment_bytes:
+                self.rotate()
+            os.write(self.fd, data)
+            self.sizes[self.write_segment] += len(data)
+            self.size += len(data)
+
+            while self.size > self.max_bytes and len(self.segments) > 1:
+                INTERNAL_LOG.warning('Log spool %s is full, discarding %s',
+                                     self.directory, self.path(self.segments[0]))
+                self.remove(self.segments[0])
+
+    def rotate(self):
+        if self.fd is not None:
+            os.close(self.fd)
+        if self.segments:
+            segment = self.segments[-1] + 1
+        else:
+            segment = 0
+        self.fd = os.open(self.path(segment), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+        self.write_segment = segment
+        self.segments.append(segment)
+        self.sizes[segment] = 0
+
+    def remove(self, segment):
+        if segment == self.write_segment:
+            os.close(self.fd)
+            self.fd = None
+            self.write_segment = None
+        if segment == self.segments[0]:
+            self.read_offset = 0
+        self.segments.remove(segment)
+        self.size -= self.sizes.pop(segment)
+        try:
+            os.unlink(self.path(segment))
+        except OSError:
+            INTERNAL_LOG.exception('Unable to remove %s', self.path(segment))
+
+    def read(self, max_bytes):
+        '''
+        Returns a (token, data) tuple with roughly max_bytes of complete lines
+        from the oldest segment, or None if the spool is empty. The data stays
+        in the spool until commit() is called with the token.
+
+        The lock is only held to choose the segment and offset, not while
+        reading the file, so that threads spooling records through write()
+        don't wait on disk reads.
+        '''
+        while True:
+            with self.lock:
+                if not self.segments:
+                    return None
+                segment = self.segments[0]
+                if segment == self.write_segment:
+                    # Stop appending to the segment so that it can be consumed
+                    os.close(self.fd)
+                    self.fd = None
+                    self.write_segment = None
+                offset = self.read_offset
+
+            try:
+                with open(self.path(segment), 'rb') as fd:
+                    fd.seek(offset)
+                    data = fd.read(max_bytes)
+                    if not data.endswith('\n'):
+                        data += fd.readline()
+            except (IOError, OSError):
+                data = None
+
+            with self.lock:
+                if not self.segments or self.segments[0] != segment:
+                    # Discarded by write() because the spool was full
+                    continue
+                if data:
+                    return ((segment, offset + len(data)), data)
+                if data is None:
+                    INTERNAL_LOG.error('Unable to read %s, discarding it', self.path(segment))
+                self.remove(segment)
+
+    def commit(self, token):
+        '''
+        Discard the data returned by the read() call that returned token.
+        '''
+        segment, offset = token
+        with self.lock:
+            if not self.segments or self.segments[0] != segment:
+                return
+            if offset >= self.sizes[segment]:
+                self.remove(segment)
+            else:
+                self.read_offset = offset
+
 
 class TCPHandler(logging.Handler):
     '''
     Python logging handler for sending JSON formatted messages over
     TCP, optionally wrapping the connection with TLSv1
     '''
-    def __init__(self, host, port, ssl_ca_file=None):
+    def __init__(self, host, port, ssl_ca_file=None,
+                 batch_records=BATCH_RECORDS, batch_bytes=BATCH_BYTES,
+                 queue_size=LOG_QUEUE_SIZE, overflow=DROP_NEWEST,
+                 overflow_level=logging.WARNING, stats_prefix=None,
+                 json_module=None, compression=None,
+                 compression_level=zlib.Z_DEFAULT_COMPRESSION, spool_dir=None,
+                 spool_segment_bytes=SPOOL_SEGMENT_BYTES,
+                 spool_max_bytes=SPOOL_MAX_BYTES):
         '''
         Instantiate a TCPHandler with the intent of connecting to the
         given host (string) and port (int) with or without using SSL/TLSv1
+
+        Records are sent in batches of up to batch_records records or
+        batch_bytes bytes, whichever is reached first, with a single write.
+
+        When more than queue_size records are waiting to be sent, emit() never
+        blocks. Records are dropped according to the overflow policy instead:
+        drop_newest discards the record being emitted, drop_oldest discards
+        the oldest queued record, and drop_by_level discards the oldest queued
+        record for records of overflow_level or higher and the record being
+        emitted otherwise.
+
+        If stats_prefix is set, the queue depth, number of dropped records and
+        send latency are reported through clay.stats under that prefix.
+
+        json_module optionally names the JSON module used to encode records.
+
+        If compression is 'zlib' or 'gzip', each batch is compressed and sent
+        as a length prefixed frame instead of plain newline delimited JSON.
+        clay.logreceiver is a reference implementation of a receiver.
+
+        If spool_dir is set, records are written to a DiskSpool in that
+        directory instead of being dropped when the queue is full, and batches
+        that fail to send are spooled rather than retried from memory. Spooled
+        records are replayed whenever the queue is empty.
         '''
         logging.Handler.__init__(self)
         self.host = host
         self.port = port
         self.ssl_ca_file = ssl_ca_file
         self.sock = None
-        self.queue = Queue(LOG_QUEUE_SIZE)
+        self.queue = Queue(queue_size)
+        self.batch_records = batch_records
+        self.batch_bytes = batch_bytes
+        self.pending = None
+
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('Unknown overflow policy: %s' % overflow)
+        if isinstance(overflow_level, six.string_types):
+            overflow_level = logging.getLevelName(overflow_level)
+        self.overflow = overflow
+        self.overflow_level = overflow_level
+        self.dropped = 0
+        self.sent = 0
+        self.send_latency = None
+        self.stats_prefix = stats_prefix
+        self.stats = HandlerStats(stats_prefix) if stats_prefix else None
+
+        if compression is not None and compression not in COMPRESSION_WBITS:
+            raise ValueError('Unknown compression: %s' % compression)
+        self.compression = compression
+        self.compression_level = compression_level
+
+        self.spool = None
+        if spool_dir is not None:
+            self.spool = DiskSpool(spool_dir, spool_segment_bytes, spool_max_bytes)
         self.connect_wait = BACKOFF_INITIAL
         self.raiseExceptions = 0
 
-        self.hostname = socket.gethostname()
-        if self.hostname.find('.') != -1:
-            self.hostname = self.hostname.split('.', 1)[0]
+        self.encoder = RecordEncoder(json_module=json_module)
+        self.hostname = self.encoder.hostname
 
         self.sender = threading.Thread(target=self.run)
         self.sender.setDaemon(True)
@@ -66,76 +527,234 @@ class TCPHandler(logging.Handler):
         '''
         Translate a LogRecord instance into a json_event
         '''
-        timestamp = datetime.utcfromtimestamp(record.created)
-        timestamp = timestamp.isoformat()
-
-        fields = {
-            'level': record.levelname,
-            'filename': record.pathname,
-            'lineno': record.lineno,
-            'method': record.funcName,
-        }
-        if record.exc_info:
-            fields['exception'] = str(record.exc_info)
-            fields['traceback'] = format_exc(record.exc_info)
-
-        log = {
-            '@source_host': self.hostname,
-            '@timestamp': timestamp,
-            '@tags': [record.name],
-            '@message': record.getMessage(),
-            '@fields': fields,
-        }
-        return json.dumps(log)
+        return self.encoder.encode(record)
 
     def emit(self, record):
         '''
         Send a LogRecord object formatted as json_event via a
         queue and worker thread.
         '''
-        self.queue.put_nowait(record)
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.handle_overflow(record)
+
+    def forward(self, data):
+        '''
+        Queue a string of one or more newline terminated json_events that
+        were serialized elsewhere, such as by a UnixHandler in another process.
+        If the queue is full, the data is spooled or dropped.
+        '''
+        try:
+            self.queue.put_nowait(data)
+        except Full:
+            if self.spool is not None:
+                try:
+                    self.spool.write(data)
+                    return
+                except Exception:
+                    INTERNAL_LOG.exception('Unable to spool log records')
+            self.dropped += data.count('\n')
+
+    def handle_overflow(self, record):
+        '''
+        Called by emit() when the queue is full. Spools the given record if a
+        spool is configured, otherwise drops either the given record or the
+        oldest queued record according to the overflow policy.
+
+        Spooling is synchronous: the record is serialized and written to disk
+        on the thread that logged it.
+        '''
+        if self.spool is not None:
+            try:
+                self.spool.write('%s\n' % self.jsonify(record))
+                return
+            except Exception:
+                INTERNAL_LOG.exception('Unable to spool log record')
+        if self.overflow == DROP_NEWEST or (self.overflow == DROP_BY_LEVEL and
+                                            record.levelno < self.overflow_level):
+            self.dropped += 1
+            return
+        self.replace_oldest(record)
+
+    def replace_oldest(self, item):
+        '''
+        Drop the oldest queued record and enqueue the given item in its place.
+        If the oldest item is the sentinel queued by close(), it is kept so
+        that the worker thread still exits, and the given item is dropped.
+        '''
+        try:
+            oldest = self.queue.get_nowait()
+        except Empty:
+            pass
+        else:
+            self.queue.task_done()
+            if oldest is None:
+                self.queue.put(None)
+                if item is not None:
+                    self.dropped += 1
+                return
+            self.dropped += 1
+        try:
+            self.queue.put_nowait(item)
+        except Full:
+            self.dropped += 1
 
     def run(self):
         '''
         Main loop of the logger thread. All network I/O and exception handling
-        originates here. Strings are consumed from self.queue and sent to
-        self.sock, creating a new connection if necessary.
+        originates here. Records are consumed from self.queue in batches,
+        serialized into a single string and sent to self.sock, creating a new
+        connection if necessary. Spooled records are sent whenever the queue
+        is empty.
 
-        If any exceptions are caught, the message is put() back on the queue
-        and the exception is allowed to propagate up through
-        logging.Handler.handleError(), potentially causing this thread to abort.
+        If any exceptions are caught, the batch is spooled, or kept and
+        retried after reconnecting if there is no spool, and the exception is
+        allowed to propagate up through logging.Handler.handleError(),
+        potentially causing this thread to abort.
         '''
         INTERNAL_LOG.debug('Log I/O thread started')
-        while True:
-            record = self.queue.get()
-            if record is None:
-                break
+        running = True
+        while running or self.pending is not None:
+            # Reported on every pass, including failed sends and idle
+            # timeouts, so that stats keep updating while the collector is
+            # down. HandlerStats limits how often they are actually sent.
+            if self.stats is not None:
+                self.report_stats()
 
-            jsonrecord = self.jsonify(record)
-            jsonrecord = '%s\n' % jsonrecord
+            if self.pending is None:
+                self.pending, running = self.next_batch()
+                if self.pending is None:
+                    continue
 
+            records, data, token = self.pending
             try:
                 if self.sock is None:
                     self.connect()
-                self.send(jsonrecord)
+                start = time.time()
+                self.send(self.frame(data))
+                self.send_latency = (time.time() - start) * 1000.0
+                self.sent += len(records)
             except Exception:
-                # This exception will be silently ignored and the message
-                # requeued unless self.raiseExceptions=1
-                self.queue.put(record)
-                self.handleError(record)
-            self.queue.task_done()
+                if self.spool is not None:
+                    self.spool_pending()
+                # This exception will be silently ignored and the batch
+                # retried unless self.raiseExceptions=1
+                self.handleError(records[0] if records else None)
+                continue
+
+            self.pending = None
+            if token is not None:
+                self.spool.commit(token)
+            for record in records:
+                self.queue.task_done()
         INTERNAL_LOG.debug('Log I/O thread exited cleanly')
 
+    def next_batch(self):
+        '''
+        Returns a tuple of ((records, data, token), running) for the next batch
+        to be sent, or (None, running) if there is nothing to send yet. Queued
+        records take priority over spooled records, which have a spool token.
+        '''
+        if self.spool is None or not self.spool.size:
+            records, data, running = self.get_batch()
+        else:
+            records, data, running = self.get_batch(block=False)
+            if not records:
+                spooled = self.spool.read(self.batch_bytes)
+                if spooled is not None:
+                    return (([], spooled[1], spooled[0]), running)
+        if not records:
+            return (None, running)
+        return ((records, data, None), running)
+
+    def spool_pending(self):
+        '''
+        Move the pending batch from memory to the spool. Batches read from the
+        spool are left there to be read again.
+        '''
+        records, data, token = self.pending
+        self.pending = None
+        if token is None:
+            try:
+                self.spool.write(data)
+            except Exception:
+                INTERNAL_LOG.exception('Unable to spool log records')
+                self.dropped += len(records)
+        for record in records:
+            self.queue.task_done()
+
+    def frame(self, data):
+        '''
+        Returns data as it should be sent to the server, compressed and
+        framed if compression is enabled.
+        '''
+        if self.compression:
+            return compress_frame(data, self.compression, self.compression_level)
+        return data
+
+    def report_stats(self):
+        '''
+        Report queue depth, dropped records and send latency to clay.stats, at
+        most once every STATS_INTERVAL seconds.
+        '''
+        self.stats.report(
+            gauges={'queue_depth': self.queue.qsize()},
+            counts={'dropped': self.dropped},
+            timings={'send_latency': self.send_latency})
+
+    def get_batch(self, block=True):
+        '''
+        Wait until a record is available if block is True, then take up to
+        batch_records records or batch_bytes bytes from the queue without
+        blocking again. If stats are enabled, waiting gives up after
+        STATS_INTERVAL seconds so that they can be reported while idle.
+        Returns a tuple of (records, data, running) where data is the newline
+        delimited json_event representation of the records and running is
+        False if the None sentinel was consumed.
+        '''
+        records = []
+        lines = []
+        size = 0
+        running = True
+        timeout = None
+        if block and self.stats is not None:
+            timeout = STATS_INTERVAL
+        try:
+            record = self.queue.get(block, timeout)
+        except Empty:
+            return (records, '', running)
+        while True:
+            if record is None:
+                self.queue.task_done()
+                running = False
+                break
+
+            try:
+                if isinstance(record, six.string_types):
+                    line = record
+                else:
+                    line = '%s\n' % self.jsonify(record)
+                records.append(record)
+                lines.append(line)
+                size += len(line)
+            except Exception:
+                INTERNAL_LOG.exception('Unable to serialize log record')
+                self.queue.task_done()
+
+            if len(records) >= self.batch_records or size >= self.batch_bytes:
+                break
+            try:
+                record = self.queue.get_nowait()
+            except Empty:
+                break
+        return (records, ''.join(lines), running)
+
     def send(self, data):
         '''
-        Keep calling SSLSocket.write until the entire message has been sent
+        Send the entire string to the server with a single write
         '''
-        while len(data) > 0:
-            if self.ssl_ca_file:
-                sent = self.sock.write(data)
-            else:
-                sent = self.sock.send(data)
-            data = data[sent:]
+        self.sock.sendall(data)
         self.connect_wait = BACKOFF_INITIAL
 
     def handleError(self, record):
@@ -149,7 +768,8 @@ class TCPHandler(logging.Handler):
         INTERNAL_LOG.exception('Unable to send log')
         self.cleanup()
         self.connect_wait *= BACKOFF_MULTIPLE
-        logging.Handler.handleError(self, record)
+        if isinstance(record, logging.LogRecord):
+            logging.Handler.handleError(self, record)
 
     def cleanup(self):
         '''
@@ -164,9 +784,13 @@ class TCPHandler(logging.Handler):
     def close(self):
         '''
         Send a sentinel None object to the worker thread, telling it to exit
-        and disconnect from the server.
+        and disconnect from the server. If the queue is full, the oldest record
+        is dropped to make room for the sentinel.
         '''
-        self.queue.put(None)
+        try:
+            self.queue.put_nowait(None)
+        except Full:
+            self.replace_oldest(None)
         self.cleanup()
         #self.sender.join()
 
@@ -175,20 +799,53 @@ class UDPHandler(logging.Handler):
     '''
     Python logging handler for sending JSON formatted messages over UDP
     '''
-    def __init__(self, host, port):
+    def __init__(self, host, port, json_module=None, queued=False,
+                 max_payload=None, oversize=OVERSIZE_TRUNCATE,
+                 queue_size=LOG_QUEUE_SIZE, stats_prefix=None):
         '''
         Instantiate a UDPHandler with the intent of connecting to the
         given host (string) and port (int)
+
+        If max_payload is set, records that would make a datagram larger than
+        max_payload bytes are either truncated with
+        RecordEncoder.encode_truncated() or dropped, according to oversize.
+
+        If queued is True, records are sent by a worker thread which packs as
+        many queued records as fit into each datagram, newline delimited, and
+        max_payload defaults to UDP_MAX_PAYLOAD. If the queue is full, records
+        are dropped.
+
+        The number of records that were coalesced into a datagram with other
+        records, truncated or dropped are counted and, if stats_prefix is set,
+        reported through clay.stats under that prefix.
         '''
         logging.Handler.__init__(self)
         self.host = host
         self.port = port
         self.sock = None
+        self.sender = None
         self.raiseExceptions = 0
 
-        self.hostname = socket.gethostname()
-        if self.hostname.find('.') != -1:
-            self.hostname = self.hostname.split('.', 1)[0]
+        if oversize not in (OVERSIZE_TRUNCATE, OVERSIZE_DROP):
+            raise ValueError('Unknown oversize policy: %s' % oversize)
+        if max_payload is None and queued:
+            max_payload = UDP_MAX_PAYLOAD
+        self.max_payload = max_payload
+        self.oversize = oversize
+        self.coalesced = 0
+        self.truncated = 0
+        self.dropped = 0
+        self.stats = HandlerStats(stats_prefix) if stats_prefix else None
+
+        self.encoder = RecordEncoder(json_module=json_module)
+        self.hostname = self.encoder.hostname
+
+        self.queue = None
+        if queued:
+            self.queue = Queue(queue_size)
+            self.sender = threading.Thread(target=self.run)
+            self.sender.setDaemon(True)
+            self.sender.start()
 
     def connect(self):
         '''
@@ -202,44 +859,178 @@ class UDPHandler(logging.Handler):
         '''
         Translate a LogRecord instance into a json_event
         '''
-        timestamp = datetime.utcfromtimestamp(record.created)
-        timestamp = timestamp.isoformat()
-
-        fields = {
-            'level': record.levelname,
-            'filename': record.pathname,
-            'lineno': record.lineno,
-            'method': record.funcName,
-        }
-        if record.exc_info:
-            fields['exception'] = str(record.exc_info)
-            fields['traceback'] = format_exc(record.exc_info)
+        return self.encoder.encode(record)
 
-        log = {
-            '@source_host': self.hostname,
-            '@timestamp': timestamp,
-            '@tags': [record.name],
-            '@message': record.getMessage(),
-            '@fields': fields,
-        }
-        return json.dumps(log)
+    def serialize(self, record):
+        '''
+        Returns the newline terminated json_event for the record, truncated to
+        fit in max_payload bytes, or None if the record should be dropped.
+        '''
+        line = '%s\n' % self.jsonify(record)
+        if self.max_payload is None or len(line) <= self.max_payload:
+            return line
+        if self.oversize == OVERSIZE_TRUNCATE:
+            event = self.encoder.encode_truncated(record, self.max_payload)
+            if event is not None:
+                self.truncated += 1
+                return '%s\n' % event
+        self.dropped += 1
+        return None
 
     def emit(self, record):
         '''
-        Send a LogRecord object formatted as json_event via a
-        queue and worker thread.
+        Send a LogRecord object formatted as json_event, or queue it for the
+        worker thread if queued is enabled.
         '''
+        if self.queue is not None:
+            try:
+                self.queue.put_nowait(record)
+            except Full:
+                self.dropped += 1
+            return
+
         try:
+            line = self.serialize(record)
+            if line is None:
+                return
             if self.sock is None:
                 self.connect()
-            jsonrecord = self.jsonify(record)
-            jsonrecord = '%s\n' % jsonrecord
-            self.sock.sendall(jsonrecord)
+            self.sock.sendall(line)
         except Exception:
             INTERNAL_LOG.exception('Error sending message to log server')
             self.close()
 
+    def run(self):
+        '''
+        Main loop of the worker thread. Waits for a record, then packs it and
+        any other queued records into datagrams of up to max_payload bytes.
+        '''
+        INTERNAL_LOG.debug('Log I/O thread started')
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+
+            lines = []
+            size = 0
+            while record is not None:
+                try:
+                    line = self.serialize(record)
+                except Exception:
+                    INTERNAL_LOG.exception('Unable to serialize log record')
+                    self.dropped += 1
+                    line = None
+                if line is not None:
+                    if size + len(line) > self.max_payload:
+                        self.send(lines)
+                        lines = []
+                        size = 0
+                    lines.append(line)
+                    size += len(line)
+                try:
+                    record = self.queue.get_nowait()
+                except Empty:
+                    break
+            self.send(lines)
+
+            if self.stats is not None:
+                self.stats.report(
+                    gauges={'queue_depth': self.queue.qsize()},
+                    counts={
+                        'coalesced': self.coalesced,
+                        'truncated': self.truncated,
+                        'dropped': self.dropped,
+                    })
+            if record is None:
+                break
+        INTERNAL_LOG.debug('Log I/O thread exited cleanly')
+
+    def send(self, lines):
+        '''
+        Send the given lines as a single datagram
+        '''
+        if not lines:
+            return
+        try:
+            if self.sock is None:
+                self.connect()
+            self.sock.send(''.join(lines))
+            if len(lines) > 1:
+                self.coalesced += len(lines)
+        except Exception:
+            INTERNAL_LOG.exception('Error sending message to log server')
+            self.dropped += len(lines)
+            self.disconnect()
+
+    def close(self, timeout=CLOSE_TIMEOUT):
+        '''
+        If queued, send a sentinel None object to the worker thread and wait
+        up to timeout seconds for it to send the records queued before it and
+        exit. If the queue is full, the oldest record is dropped to make room
+        for the sentinel. Then disconnect from the server.
+        '''
+        if self.queue is not None and self.sender is not None:
+            try:
+                self.queue.put_nowait(None)
+            except Full:
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                except Empty:
+                    pass
+                self.queue.put_nowait(None)
+            self.sender.join(timeout)
+            self.sender = None
+        self.disconnect()
+
+    def disconnect(self):
+        '''
+        Close the socket, if any. The next send reconnects.
+        '''
+        if self.sock:
+            self.sock.close()
+        self.sock = None
+
+
+class UnixHandler(logging.Handler):
+    '''
+    Python logging handler for sending JSON formatted messages to a
+    clay.logforwarder process on the same host over a Unix datagram socket.
+    Each record is a single non-blocking sendto(), so many worker processes
+    can share the forwarder's one connection to the log server. Records are
+    dropped and counted if the forwarder is not running or can't keep up.
+    '''
+    def __init__(self, path=FORWARDER_SOCKET, json_module=None):
+        logging.Handler.__init__(self)
+        self.path = path
+        self.sock = None
+        self.pid = None
+        self.dropped = 0
+        self.encoder = RecordEncoder(json_module=json_module)
+
+    def connect(self):
+        '''
+        Create the socket. A new socket is created after forking so that
+        processes don't share one.
+        '''
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        self.pid = os.getpid()
+
+    def emit(self, record):
+        '''
+        Send a LogRecord object formatted as json_event to the forwarder
+        '''
+        try:
+            if self.sock is None or self.pid != os.getpid():
+                self.connect()
+            self.sock.sendto('%s\n' % self.encoder.encode(record), self.path)
+        except Exception:
+            # Logging the error here would recurse back into this handler
+            self.dropped += 1
+
     def close(self):
         if self.sock:
             self.sock.close()
         self.sock = None
+        logging.Handler.close(self)
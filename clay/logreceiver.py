@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+'''
+Reference receiver for clay.logger.TCPHandler, useful for testing log
+shipping locally. Accepts connections from handlers sending either plain
+newline delimited json_events or compressed frames, and writes each event
+to stdout on its own line.
+
+    clay-logreceiver --port 5140 --compression zlib
+'''
+from __future__ import absolute_import
+from six.moves import socketserver
+import argparse
+import threading
+import socket
+import sys
+
+from clay import logger
+
+
+def read_exactly(sock, size):
+    '''
+    Read size bytes from the socket. Returns None if the connection was
+    closed first.
+    '''
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(size)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+
+def read_frames(sock, compression):
+    '''
+    Generator yielding the decompressed newline delimited json_events of
+    each frame received on the socket until it is closed.
+    '''
+    header_size = logger.FRAME_HEADER.size
+    while True:
+        header = read_exactly(sock, header_size)
+        if header is None:
+            return
+        length = logger.FRAME_HEADER.unpack(header)[0]
+        payload = read_exactly(sock, length)
+        if payload is None:
+            return
+        yield logger.decompress_frame(payload, compression)
+
+
+def read_lines(sock):
+    '''
+    Generator yielding chunks of newline delimited json_events received on
+    the socket until it is closed.
+    '''
+    buf = ''
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            return
+        buf += chunk
+        end = buf.rfind('\n') + 1
+        if end:
+            yield buf[:end]
+            buf = buf[end:]
+
+
+class LogReceiver(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, compression=None, output=sys.stdout):
+        socketserver.ThreadingTCPServer.__init__(self, address, LogRequestHandler)
+        self.compression = compression
+        self.output = output
+        self.lock = threading.Lock()
+
+    def write(self, data):
+        with self.lock:
+            self.output.write(data)
+            self.output.flush()
+
+
+class LogRequestHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        if self.server.compression:
+            chunks = read_frames(self.request, self.server.compression)
+        else:
+            chunks = read_lines(self.request)
+        try:
+            for data in chunks:
+                self.server.write(data)
+        except socket.error:
+            pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Receive logs sent by clay.logger.TCPHandler')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5140)
+    parser.add_argument('--compression', choices=sorted(logger.COMPRESSION_WBITS))
+    args = parser.parse_args()
+
+    server = LogReceiver((args.host, args.port), compression=args.compression)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -1,27 +1,148 @@
 from __future__ import absolute_import
 
+from six.moves.queue import Queue, Full, Empty
 import functools
+import threading
+import hashlib
+import bisect
+import random
 import socket
+import atexit
+import math
 import time
+import os
 
 from clay import config
 
 log = config.get_logger('clay.stats')
 
+# Per-key default sample rates for counters and timers, from
+# statsd.sample_rates. Read once at import time.
+sample_rates = config.get('statsd.sample_rates', None) or {}
+
+# Default maximum payload sizes when statsd.buffered is enabled. 1432 bytes
+# fits a UDP datagram inside a standard 1500 byte ethernet MTU.
+UDP_MAX_PACKET_SIZE = 1432
+TCP_MAX_PACKET_SIZE = 8192
+FLUSH_INTERVAL = 1.0
+STATS_QUEUE_SIZE = 10000
+CLOSE_TIMEOUT = 2.0
+
+# Histogram buckets grow by 2% so that percentiles are accurate to within 1%
+HISTOGRAM_PRECISION = 0.02
+HISTOGRAM_MIN_VALUE = 0.001
+PERCENTILES = [50, 90, 99]
+
+# Number of points each server occupies on the consistent hash ring
+HASH_RING_REPLICAS = 100
+HASH_RING_CACHE_SIZE = 10000
+
+
+class Flusher(object):
+    '''
+    Daemon thread that calls flush() on every registered object at a fixed
+    interval. Threads don't survive fork(), so registered objects call check()
+    as they buffer stats, which starts a new thread in a forked child.
+    '''
+    def __init__(self, interval=FLUSH_INTERVAL):
+        self.interval = interval
+        self.targets = []
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+
+    def register(self, target):
+        '''
+        Add an object with a flush() method, starting the flusher thread if it
+        is not already running.
+        '''
+        with self.lock:
+            if target not in self.targets:
+                self.targets.append(target)
+            self.start()
+
+    def check(self):
+        '''
+        Start a new flusher thread if this process was forked after the
+        current one was started.
+        '''
+        if self.pid != os.getpid():
+            with self.lock:
+                self.start()
+
+    def start(self):
+        # Called with self.lock held
+        pid = os.getpid()
+        if self.thread is None or self.pid != pid:
+            self.pid = pid
+            self.thread = threading.Thread(target=self.run)
+            self.thread.setDaemon(True)
+            self.thread.start()
+
+    def run(self):
+        log.debug('Stats flusher thread started')
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def flush(self):
+        '''
+        Flush all registered objects, logging and ignoring any exceptions.
+        '''
+        for target in list(self.targets):
+            try:
+                target.flush()
+            except Exception:
+                log.exception('Unable to flush %s', target)
+
+flusher = Flusher(config.get('statsd.flush_interval', FLUSH_INTERVAL))
+
 
 class StatsConnection(object):
     '''
     Handles the lifecycle of stats sockets and connections.
+
+    If statsd.buffered is enabled, stats are accumulated in memory and written
+    as a single UDP datagram or TCP write of up to statsd.max_packet_size
+    bytes. Buffers are flushed when full, every statsd.flush_interval seconds
+    and at interpreter exit. If autoflush is False, the periodic flush is left
+    to the caller.
+
+    If host and port are given, they are used instead of statsd.host and
+    statsd.port.
     '''
-    def __init__(self):
+    def __init__(self, autoflush=True, host=None, port=None):
         self.sock = None
         self.proto = None
-        self.host = None
-        self.port = None
+        self.host = host
+        self.port = port
+        self.endpoint = (host, port) if host is not None else None
         self.next_retry = None
         self.backoff = 0.5
         self.max_backoff = 10.0
 
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.buffer_size = 0
+        self.buffered = False
+        self.max_packet_size = UDP_MAX_PACKET_SIZE
+        self.autoflush = autoflush
+        self.configure()
+
+    def configure(self):
+        '''
+        Read buffering options from the config. Called upon initialization
+        and whenever a new socket is created.
+        '''
+        self.buffered = config.get('statsd.buffered', False)
+        if config.get('statsd.protocol', 'udp') == 'tcp':
+            default_size = TCP_MAX_PACKET_SIZE
+        else:
+            default_size = UDP_MAX_PACKET_SIZE
+        self.max_packet_size = config.get('statsd.max_packet_size', default_size)
+        if self.buffered and self.autoflush:
+            flusher.register(self)
+
     def __str__(self):
         if self.sock is not None:
             return 'StatsConnection %s %s:%i (connected)' % (
@@ -40,10 +161,12 @@ class StatsConnection(object):
         if self.sock is not None:
             return (self.proto, self.sock)
 
+        self.configure()
         proto = config.get('statsd.protocol', 'udp')
         self.proto = proto
-        self.host = config.get('statsd.host', None)
-        self.port = config.get('statsd.port', 8125)
+        if self.endpoint is None:
+            self.host = config.get('statsd.host', None)
+            self.port = config.get('statsd.port', 8125)
 
         if self.host is None or self.port is None:
             return (self.proto, None)
@@ -103,45 +226,572 @@ class StatsConnection(object):
     def send(self, stat):
         '''
         Send a raw stat line to statsd. A new socket will be opened and
-        connected if necessary. Returns True if the stat was sent successfully.
+        connected if necessary. Returns True if the stat was sent (or buffered)
+        successfully.
 
         :param stat: The stat to be sent to statsd, with no trailing newline
         :type stat: string
+        :rtype: boolean
+        '''
+        if not stat.endswith('\n'):
+            stat += '\n'
+
+        if not self.buffered:
+            return self.write(stat)
+
+        if self.autoflush:
+            flusher.check()
+        with self.lock:
+            if self.buffer_size + len(stat) > self.max_packet_size:
+                self._flush()
+            self.buffer.append(stat)
+            self.buffer_size += len(stat)
+            if self.buffer_size >= self.max_packet_size:
+                self._flush()
+        return True
+
+    def flush(self):
+        '''
+        Write any buffered stats to the socket. Returns False if the write
+        failed, in which case the buffered stats are discarded.
+
+        :rtype: boolean
+        '''
+        with self.lock:
+            return self._flush()
+
+    def _flush(self):
+        if not self.buffer:
+            return True
+        data = ''.join(self.buffer)
+        self.buffer = []
+        self.buffer_size = 0
+        return self.write(data)
+
+    def write(self, data):
+        '''
+        Write one or more newline terminated stat lines to the socket as a
+        single datagram or TCP write. Returns True if the write succeeded.
+
         :rtype: boolean
         '''
         proto, sock = self.get_socket()
         if sock is None:
             return False
 
-        if not stat.endswith('\n'):
-            stat += '\n'
-
         try:
             if proto == 'udp':
-                sock.sendto(stat, 0, (self.host, self.port))
+                sock.sendto(data, 0, (self.host, self.port))
                 return True
 
             if proto == 'tcp':
-                sock.sendall(stat)
+                sock.sendall(data)
                 return True
         except socket.error:
             log.exception('Unable to send to statsd, resetting socket')
             self.reset()
         return False
 
-connection = StatsConnection()
+    def close(self, timeout=CLOSE_TIMEOUT):
+        '''
+        Flush any buffered stats and close the socket.
+        '''
+        self.flush()
+        self.reset()
+
+
+class AsyncStatsConnection(object):
+    '''
+    Sends stats from a daemon thread, similar to clay.logger.TCPHandler.
+    Callers only enqueue stat lines while the sender thread owns the wrapped
+    connection and its socket, so a slow or unreachable statsd never blocks the
+    caller. If the queue is full, the stat is dropped and counted.
+
+    Enabled by setting statsd.asynchronous in the config. The queue size is
+    set by statsd.queue_size.
+
+    The sender thread doesn't survive fork(), so a forked child starts its
+    own, with an empty queue, the first time it sends a stat.
+    '''
+    FLUSH = object()
+
+    def __init__(self, connection, queue_size=STATS_QUEUE_SIZE,
+                 flush_interval=FLUSH_INTERVAL):
+        self.connection = connection
+        self.queue_size = queue_size
+        self.queue = Queue(queue_size)
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self.reported_drops = 0
+        self.lock = threading.Lock()
+        self.sender = None
+        self.pid = None
+        self.start()
+
+    def start(self):
+        '''
+        Start the sender thread, or start a new one with an empty queue if
+        this process was forked after the current one was started. Stats
+        queued before the fork belong to the parent, which sends them.
+        '''
+        with self.lock:
+            pid = os.getpid()
+            if self.pid == pid:
+                return
+            if self.pid is not None:
+                self.queue = Queue(self.queue_size)
+            self.pid = pid
+            self.sender = threading.Thread(target=self.run)
+            self.sender.setDaemon(True)
+            self.sender.start()
+
+    def __str__(self):
+        return 'AsyncStatsConnection %s (%i queued, %i dropped)' % (
+               self.connection, self.queue.qsize(), self.dropped)
+
+    @property
+    def max_packet_size(self):
+        return self.connection.max_packet_size
+
+    def send(self, stat):
+        '''
+        Enqueue a raw stat line to be sent by the sender thread. Returns False
+        if the queue is full and the stat was dropped.
+
+        :rtype: boolean
+        '''
+        if self.pid != os.getpid():
+            self.start()
+        try:
+            self.queue.put_nowait(stat)
+            return True
+        except Full:
+            self.dropped += 1
+            return False
+
+    def flush(self):
+        '''
+        Ask the sender thread to flush the wrapped connection.
+        '''
+        return self.send(self.FLUSH)
+
+    def close(self, timeout=CLOSE_TIMEOUT):
+        '''
+        Wait up to timeout seconds for the sender thread to send everything
+        queued before this call, then tell it to exit.
+        '''
+        if self.pid != os.getpid():
+            self.start()
+        done = threading.Event()
+        try:
+            self.queue.put((self.FLUSH, done), timeout=timeout)
+            self.queue.put(None, timeout=timeout)
+        except Full:
+            return
+        done.wait(timeout)
+
+    def run(self):
+        '''
+        Main loop of the sender thread. Stats are consumed from self.queue and
+        passed to the wrapped connection, which is flushed at least every
+        flush_interval seconds, whether or not the queue is busy.
+        '''
+        log.debug('Stats sender thread started')
+        last_flush = time.time()
+        while True:
+            timeout = max(last_flush + self.flush_interval - time.time(), 0)
+            try:
+                stat = self.queue.get(timeout=timeout)
+            except Empty:
+                stat = self.FLUSH
+            if stat is None:
+                break
+
+            try:
+                if stat is self.FLUSH:
+                    self.connection.flush()
+                    self.report_drops()
+                    last_flush = time.time()
+                elif isinstance(stat, tuple):
+                    self.connection.flush()
+                    last_flush = time.time()
+                    stat[1].set()
+                else:
+                    self.connection.send(stat)
+                    if time.time() - last_flush >= self.flush_interval:
+                        self.connection.flush()
+                        self.report_drops()
+                        last_flush = time.time()
+            except Exception:
+                log.exception('Unexpected error in stats sender thread')
+        log.debug('Stats sender thread exited cleanly')
+
+    def report_drops(self):
+        dropped = self.dropped
+        if dropped > self.reported_drops:
+            log.warning('Stats queue full, dropped %i stats',
+                        dropped - self.reported_drops)
+            self.reported_drops = dropped
+
+
+def hash_key(key):
+    '''
+    Returns a 32 bit integer hash of the given string that is stable across
+    processes and hosts.
+    '''
+    if not isinstance(key, bytes):
+        key = key.encode('utf-8')
+    return int(hashlib.md5(key).hexdigest()[:8], 16)
+
+
+class ShardedStatsConnection(object):
+    '''
+    Distributes stats across several statsd servers by consistent hashing of
+    the metric key, so that every stat for a given key is aggregated by the
+    same server and adding or removing a server only moves a fraction of the
+    keys. Each server has its own StatsConnection, with its own socket, buffer
+    and retry backoff.
+
+    Enabled by setting statsd.hosts in the config to a list of "host:port"
+    strings or {"host": ..., "port": ...} objects.
+    '''
+    def __init__(self, hosts, autoflush=True):
+        self.connections = []
+        ring = []
+        for host, port in hosts:
+            conn = StatsConnection(autoflush=autoflush, host=host, port=port)
+            self.connections.append(conn)
+            for i in range(HASH_RING_REPLICAS):
+                ring.append((hash_key('%s:%i-%i' % (host, port, i)), conn))
+        ring.sort(key=lambda point: point[0])
+        self.ring_hashes = [point[0] for point in ring]
+        self.ring_connections = [point[1] for point in ring]
+        self.cache = {}
+
+    def __str__(self):
+        return 'ShardedStatsConnection [%s]' % ', '.join(
+               [str(conn) for conn in self.connections])
+
+    @property
+    def max_packet_size(self):
+        return min([conn.max_packet_size for conn in self.connections])
+
+    def get_connection(self, key):
+        '''
+        Returns the StatsConnection responsible for the given metric key.
+        '''
+        conn = self.cache.get(key)
+        if conn is not None:
+            return conn
+        i = bisect.bisect(self.ring_hashes, hash_key(key))
+        conn = self.ring_connections[i % len(self.ring_connections)]
+        if len(self.cache) >= HASH_RING_CACHE_SIZE:
+            self.cache = {}
+        self.cache[key] = conn
+        return conn
+
+    def send(self, stat):
+        '''
+        Send a raw stat line to the server responsible for its key.
+
+        :rtype: boolean
+        '''
+        return self.get_connection(stat.split(':', 1)[0]).send(stat)
+
+    def flush(self):
+        success = True
+        for conn in self.connections:
+            success = conn.flush() and success
+        return success
+
+    def close(self, timeout=CLOSE_TIMEOUT):
+        for conn in self.connections:
+            conn.close(timeout)
+
+
+def parse_hosts(hosts):
+    '''
+    Convert a list of "host:port" strings or {"host": ..., "port": ...} dicts
+    into a list of (host, port) tuples. The port defaults to 8125.
+    '''
+    result = []
+    for host in hosts:
+        if isinstance(host, dict):
+            result.append((host['host'], int(host.get('port', 8125))))
+        elif ':' in host:
+            host, port = host.rsplit(':', 1)
+            result.append((host, int(port)))
+        else:
+            result.append((host, 8125))
+    return result
+
+
+def create_connection():
+    '''
+    Create a connection according to the statsd config.
+    '''
+    asynchronous = config.get('statsd.asynchronous', False)
+    hosts = config.get('statsd.hosts', None)
+    if hosts:
+        conn = ShardedStatsConnection(parse_hosts(hosts), autoflush=not asynchronous)
+    else:
+        conn = StatsConnection(autoflush=not asynchronous)
+
+    if asynchronous:
+        return AsyncStatsConnection(
+            conn,
+            queue_size=config.get('statsd.queue_size', STATS_QUEUE_SIZE),
+            flush_interval=config.get('statsd.flush_interval', FLUSH_INTERVAL))
+    return conn
+
+connection = create_connection()
 send = connection.send  # backwards compatibility
 
 
+class Aggregator(object):
+    '''
+    Accumulates stats in memory and emits one line per key every
+    statsd.flush_interval seconds, rather than one line per call. Counters are
+    summed, gauges keep their last value, set members are deduplicated and
+    timing samples are collected into a single multi-value line.
+
+    Enabled by setting statsd.aggregate in the config.
+    '''
+    def __init__(self, connection):
+        self.connection = connection
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.sets = {}
+        self.timers = {}
+        self.timer_rates = {}
+        self.enabled = config.get('statsd.aggregate', False)
+        if self.enabled:
+            flusher.register(self)
+
+    def count(self, key, n):
+        flusher.check()
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+        return True
+
+    def timing(self, key, ms, sample=1.0):
+        flusher.check()
+        with self.lock:
+            samples = self.timers.get(key)
+            if samples is None:
+                self.timers[key] = [ms]
+            else:
+                samples.append(ms)
+            if sample != 1.0:
+                self.timer_rates[key] = sample
+        return True
+
+    def gauge(self, key, value):
+        flusher.check()
+        with self.lock:
+            self.gauges[key] = value
+        return True
+
+    def unique_set(self, key, value):
+        flusher.check()
+        with self.lock:
+            members = self.sets.get(key)
+            if members is None:
+                self.sets[key] = set([value])
+            else:
+                members.add(value)
+        return True
+
+    def flush(self):
+        '''
+        Emit all aggregated stats to the connection and reset the aggregates.
+        Returns False if any stat could not be sent.
+
+        :rtype: boolean
+        '''
+        with self.lock:
+            counters, self.counters = self.counters, {}
+            gauges, self.gauges = self.gauges, {}
+            sets, self.sets = self.sets, {}
+            timers, self.timers = self.timers, {}
+            timer_rates, self.timer_rates = self.timer_rates, {}
+
+        lines = []
+        for key, n in counters.items():
+            if isinstance(n, float):
+                lines.append('%s:%f|c' % (key, n))
+            else:
+                lines.append('%s:%i|c' % (key, n))
+        for key, value in gauges.items():
+            lines.append('%s:%f|g' % (key, value))
+        for key, members in sets.items():
+            for value in members:
+                lines.append('%s:%s|s' % (key, value))
+        for key, samples in timers.items():
+            lines.extend(self.timing_lines(key, samples, timer_rates.get(key, 1.0)))
+
+        success = True
+        for line in lines:
+            success = self.connection.send(line) and success
+        return self.connection.flush() and success
+
+    def timing_lines(self, key, samples, sample=1.0):
+        '''
+        Pack timing samples into statsd multi-value lines of the form
+        key:1.0|ms:2.0|ms, splitting them so that no line is longer than the
+        connection's max_packet_size.
+        '''
+        prefix = '%s:' % key
+        if sample == 1.0:
+            suffix = '|ms'
+        else:
+            suffix = '|ms|@%f' % sample
+        values = []
+        size = len(prefix)
+        for ms in samples:
+            value = '%f%s' % (ms, suffix)
+            if values and size + len(value) + 1 > self.connection.max_packet_size:
+                yield prefix + ':'.join(values)
+                values = []
+                size = len(prefix)
+            values.append(value)
+            size += len(value) + 1
+        if values:
+            yield prefix + ':'.join(values)
+
+aggregator = Aggregator(connection)
+
+
+class Histogram(object):
+    '''
+    Streaming histogram with logarithmic buckets, in the style of
+    HdrHistogram. Each bucket spans a range of values (1 + precision) times
+    wider than the previous one, so memory is bounded by the dynamic range of
+    the recorded values rather than the number of samples, and percentiles are
+    accurate to within precision / 2 of the true value.
+    '''
+    def __init__(self, precision=HISTOGRAM_PRECISION):
+        self.log_base = math.log(1.0 + precision)
+        self.buckets = {}
+        self.count = 0
+        self.max = None
+
+    def record(self, value):
+        if value > HISTOGRAM_MIN_VALUE:
+            bucket = int(math.log(value / HISTOGRAM_MIN_VALUE) / self.log_base)
+        else:
+            bucket = 0
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def bucket_value(self, bucket):
+        '''
+        Returns the midpoint of the given bucket
+        '''
+        return HISTOGRAM_MIN_VALUE * math.exp((bucket + 0.5) * self.log_base)
+
+    def percentiles(self, percentiles):
+        '''
+        Returns a list of estimated values for each of the given percentiles,
+        which must be in ascending order.
+        '''
+        results = []
+        if not self.count:
+            return results
+        ranks = [max(1, int(math.ceil(self.count * p / 100.0))) for p in percentiles]
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            while ranks and seen >= ranks[0]:
+                results.append(min(self.bucket_value(bucket), self.max))
+                ranks.pop(0)
+            if not ranks:
+                break
+        return results
+
+
+class Histograms(object):
+    '''
+    Records timing stats from Timer and wrapper into a Histogram per key
+    rather than sending every sample to statsd. Every statsd.flush_interval
+    seconds, the configured percentiles, max and sample count of each key are
+    emitted as gauges (key.p50, key.p90, key.p99, key.max) and a counter
+    (key.count).
+
+    Enabled by setting statsd.histograms in the config. The percentiles may be
+    changed with statsd.percentiles.
+    '''
+    def __init__(self, connection):
+        self.connection = connection
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.percentiles = sorted(config.get('statsd.percentiles', PERCENTILES))
+        self.suffixes = ['.p%s' % str(p).replace('.', '_') for p in self.percentiles]
+        self.enabled = config.get('statsd.histograms', False)
+        if self.enabled:
+            flusher.register(self)
+
+    def record(self, key, ms):
+        flusher.check()
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.record(ms)
+        return True
+
+    def flush(self):
+        '''
+        Emit a summary of each histogram to the connection and reset the
+        histograms. Returns False if any stat could not be sent.
+
+        :rtype: boolean
+        '''
+        with self.lock:
+            histograms, self.histograms = self.histograms, {}
+
+        success = True
+        for key, histogram in histograms.items():
+            values = histogram.percentiles(self.percentiles)
+            lines = ['%s%s:%f|g' % (key, suffix, value)
+                     for suffix, value in zip(self.suffixes, values)]
+            lines.append('%s.max:%f|g' % (key, histogram.max))
+            lines.append('%s.count:%i|c' % (key, histogram.count))
+            for line in lines:
+                success = self.connection.send(line) and success
+        return self.connection.flush() and success
+
+histograms = Histograms(connection)
+
+
+def close():
+    '''
+    Flush all pending stats. Called automatically at interpreter exit.
+    '''
+    flusher.flush()
+    connection.close()
+
+atexit.register(close)
+
+
 class Timer(object):
     '''
-    Context manager for recording wall-clock timing stats.
+    Context manager for recording wall-clock timing stats. If
+    statsd.histograms is enabled, the timing is recorded in a histogram
+    instead of being sent to statsd directly.
 
     with clay.stats.Timer("myapp.example"):
         # do some work
+
+    If metric is given, the elapsed time is passed to metric.record() rather
+    than looking up key on every exit. See clay.stats.timer().
     '''
-    def __init__(self, key):
+    def __init__(self, key, metric=None):
         self.key = key
+        self.metric = metric
         self.start = None
 
     def __enter__(self):
@@ -150,7 +800,131 @@ class Timer(object):
     def __exit__(self, exc_type, exc_value, exc_traceback):
         now = time.time()
         elapsed_ms = ((now - self.start) * 1000.0)
-        timing(self.key, elapsed_ms)
+        if self.metric is not None:
+            self.metric.record(elapsed_ms)
+        elif histograms.enabled:
+            histograms.record(self.key, elapsed_ms)
+        else:
+            timing(self.key, elapsed_ms)
+
+
+class Counter(object):
+    '''
+    Handle for a counter with a fixed key, returned by clay.stats.counter().
+    The stat lines are built once when the handle is created, so incrementing
+    a counter in a hot loop does no string formatting in the common case.
+
+    If sample is not given, the rate from statsd.sample_rates is used.
+    '''
+    def __init__(self, key, sample=None):
+        if sample is None:
+            sample = sample_rates.get(key, 1.0)
+        self.key = key
+        self.sample = sample
+        self.prefix = '%s:' % key
+        if sample == 1.0:
+            self.suffix = '|c\n'
+        else:
+            self.suffix = '|c|@%f\n' % sample
+        self.increment = '%s:1%s' % (key, self.suffix)
+        self.decrement = '%s:-1%s' % (key, self.suffix)
+
+    def incr(self, n=1):
+        '''
+        Increment the counter by n, or decrement if n is negative.
+        '''
+        if self.sample < 1.0 and random.random() >= self.sample:
+            return True
+        if aggregator.enabled:
+            return aggregator.count(self.key, n / self.sample if self.sample != 1.0 else n)
+        if n == 1:
+            return connection.send(self.increment)
+        if n == -1:
+            return connection.send(self.decrement)
+        return connection.send('%s%i%s' % (self.prefix, n, self.suffix))
+
+    def decr(self, n=1):
+        '''
+        Decrement the counter by n.
+        '''
+        return self.incr(-n)
+
+
+class Timing(object):
+    '''
+    Handle for a timing stat with a fixed key, returned by clay.stats.timer().
+    Timings are recorded in a histogram if statsd.histograms is enabled,
+    otherwise they are sampled like Counter.
+    '''
+    def __init__(self, key, sample=None):
+        if sample is None:
+            sample = sample_rates.get(key, 1.0)
+        self.key = key
+        self.sample = sample
+        self.prefix = '%s:' % key
+        if sample == 1.0:
+            self.suffix = '|ms\n'
+        else:
+            self.suffix = '|ms|@%f\n' % sample
+
+    def record(self, ms):
+        '''
+        Record a timing of ms milliseconds.
+        '''
+        if histograms.enabled:
+            return histograms.record(self.key, ms)
+        if self.sample < 1.0 and random.random() >= self.sample:
+            return True
+        if aggregator.enabled:
+            return aggregator.timing(self.key, float(ms), self.sample)
+        return connection.send('%s%f%s' % (self.prefix, ms, self.suffix))
+
+    def time(self):
+        '''
+        Returns a Timer context manager that records into this handle.
+
+        with request_time.time():
+            # do some work
+        '''
+        return Timer(self.key, self)
+
+
+def counter(key, sample=None):
+    '''
+    Returns a Counter handle for the given key. Handles should be created once,
+    for example at module level, and reused.
+
+    calls = clay.stats.counter('myapp.calls')
+    calls.incr()
+
+    :param key: Name of this counter
+    :type key: string
+    :param sample: Optional sample rate, defaults to statsd.sample_rates[key]
+                   or 1.0
+    :type sample: float
+    :rtype: Counter
+    '''
+    return Counter(key, sample)
+
+
+def timer(key, sample=None):
+    '''
+    Returns a Timing handle for the given key. Handles should be created once,
+    for example at module level, and reused.
+
+    duration = clay.stats.timer('myapp.duration')
+    duration.record(12.5)
+    with duration.time():
+        # do some work
+
+    :param key: Name of this timing stat
+    :type key: string
+    :param sample: Optional sample rate, defaults to statsd.sample_rates[key]
+                   or 1.0
+    :type sample: float
+    :rtype: Timing
+    '''
+    return Timing(key, sample)
 
 
 def count(key, n, sample=1.0):
@@ -161,17 +935,25 @@ def count(key, n, sample=1.0):
     :type key: string
     :param n: The number to increment by
     :type n: integer
-    :param sample: Optional sample rate to scale the counter by. Must be a
-                   float between 0.0 and 1.0. Defaults to 1.0
+    :param sample: Optional sample rate. Must be a float between 0.0 and 1.0.
+                   Only this fraction of calls are sent to statsd, which
+                   scales the counter up accordingly. Defaults to
+                   statsd.sample_rates[key] or 1.0
     :type sample: float
     '''
+    if sample == 1.0 and sample_rates:
+        sample = sample_rates.get(key, 1.0)
+    if sample < 1.0 and random.random() >= sample:
+        return True
+    if aggregator.enabled:
+        return aggregator.count(key, n / sample if sample != 1.0 else n)
     if sample == 1.0:
         return connection.send('%s:%i|c' % (key, n))
     else:
         return connection.send('%s:%i|c|@%f' % (key, n, sample))
 
 
-def timing(key, ms):
+def timing(key, ms, sample=1.0):
     '''
     Send a timing stat to statsd
 
@@ -179,10 +961,22 @@ def timing(key, ms):
     :type key: string
     :param ms: A floating point number of milliseconds
     :type ms: float
+    :param sample: Optional sample rate. Must be a float between 0.0 and 1.0.
+                   Defaults to statsd.sample_rates[key] or 1.0
+    :type sample: float
     '''
+    if sample == 1.0 and sample_rates:
+        sample = sample_rates.get(key, 1.0)
+    if sample < 1.0 and random.random() >= sample:
+        return True
     if not isinstance(ms, float):
         ms = float(ms)
-    return connection.send('%s:%f|ms' % (key, ms))
+    if aggregator.enabled:
+        return aggregator.timing(key, ms, sample)
+    if sample == 1.0:
+        return connection.send('%s:%f|ms' % (key, ms))
+    else:
+        return connection.send('%s:%f|ms|@%f' % (key, ms, sample))
 
 
 def gauge(key, value):
@@ -196,6 +990,8 @@ def gauge(key, value):
     '''
     if not isinstance(value, float):
         value = float(value)
+    if aggregator.enabled:
+        return aggregator.gauge(key, value)
     return connection.send('%s:%f|g' % (key, value))
 
 
@@ -209,6 +1005,8 @@ def unique_set(key, value):
     :param value: Set value
     :type value: string
     '''
+    if aggregator.enabled:
+        return aggregator.unique_set(key, value)
     return connection.send('%s:%s|s' % (key, value))
 
 
@@ -225,15 +1023,19 @@ def wrapper(prefix):
     :type key: Prefix for stats keys to be created under
     '''
 
+    calls = counter('%s.calls' % prefix)
+    exceptions = counter('%s.exceptions' % prefix)
+    duration = timer('%s.duration' % prefix)
+
     def clay_stats_wrapper(func):
         @functools.wraps(func)
         def wrap(*args, **kwargs):
-            count('%s.calls' % prefix, 1)
+            calls.incr()
             try:
-                with Timer('%s.duration' % prefix):
+                with duration.time():
                     return func(*args, **kwargs)
             except Exception:
-                count('%s.exceptions' % prefix, 1)
+                exceptions.incr()
                 raise
         return wrap
     return clay_stats_wrapper
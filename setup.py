@@ -27,6 +27,8 @@ setup(
         'console_scripts': [
             'clay-devserver = clay.server:devserver',
             'clay-celery = clay.celery:main',
+            'clay-logreceiver = clay.logreceiver:main',
+            'clay-logforwarder = clay.logforwarder:main',
         ],
     },
 )
@@ -0,0 +1,307 @@
+from __future__ import absolute_import
+
+import tempfile
+import unittest
+import shutil
+import json
+import time
+import mock
+import os
+
+os.environ['CLAY_CONFIG'] = 'config.json'
+
+from clay import config
+
+
+class TestConfigDict(unittest.TestCase):
+    def setUp(self):
+        self.config = config.ConfigDict({
+            'statsd': {'host': '127.0.0.1', 'port': 8125},
+            'enabled': False,
+            'dotted.key': 1,
+            5: 'five',
+        })
+
+    def test_lookup(self):
+        self.assertEqual(self.config.lookup('statsd.host'), '127.0.0.1')
+        self.assertEqual(self.config.lookup('statsd'), {'host': '127.0.0.1', 'port': 8125})
+        self.assertEqual(self.config.lookup('enabled', True), False)
+
+    def test_missing(self):
+        self.assertEqual(self.config.lookup('statsd.missing'), None)
+        self.assertEqual(self.config.lookup('statsd.host.missing', 'default'), 'default')
+        self.assertEqual(self.config.lookup('missing', 'default'), 'default')
+
+    def test_unreachable_keys(self):
+        self.assertEqual(self.config.lookup('dotted.key'), None)
+        self.assertEqual(self.config.lookup('5'), None)
+
+    def test_invalidate(self):
+        self.assertEqual(self.config.lookup('statsd.port'), 8125)
+        self.config['statsd'] = {'port': 8126}
+        self.assertEqual(self.config.lookup('statsd.port'), 8126)
+        self.config.update({'other': {'port': 1}})
+        self.assertEqual(self.config.lookup('other.port'), 1)
+        del self.config['other']
+        self.assertEqual(self.config.lookup('other.port'), None)
+        self.config.clear()
+        self.assertEqual(self.config.lookup('statsd.port'), None)
+
+    def test_patch_dict(self):
+        self.assertEqual(config.get('statsd.host'), '127.0.0.1')
+        with mock.patch.dict(config.CONFIG.config, {'statsd': {'host': 'example.com'}}):
+            self.assertEqual(config.get('statsd.host'), 'example.com')
+            self.assertEqual(config.get('statsd.port'), None)
+        self.assertEqual(config.get('statsd.host'), '127.0.0.1')
+        self.assertEqual(config.get('statsd.port'), 8125)
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.original = config.CONFIG.current
+
+    def tearDown(self):
+        config.CONFIG.current = self.original
+
+    def test_reload(self):
+        snapshot = config.snapshot()
+        with mock.patch.object(config.CONFIG, 'load_from_file') as load_from_file:
+            load_from_file.return_value = {'statsd': {'host': 'example.com'}}
+            config.CONFIG.load()
+
+        self.assertEqual(snapshot.get('statsd.host'), '127.0.0.1')
+        self.assertEqual(config.get('statsd.host'), 'example.com')
+        self.assertTrue(config.snapshot().version > snapshot.version)
+        self.assertTrue(config.snapshot() is not snapshot)
+
+    def test_partial_load(self):
+        # get() must keep returning the old config until loading completes
+        seen = []
+
+        def load_from_file(path):
+            seen.append(config.get('statsd.host'))
+            return {'statsd': {'host': 'example.com'}}
+
+        with mock.patch.object(config.CONFIG, 'load_from_file', side_effect=load_from_file):
+            config.CONFIG.load()
+        self.assertEqual(seen, ['127.0.0.1'])
+        self.assertEqual(config.get('statsd.host'), 'example.com')
+
+    def test_plain_dict(self):
+        # Assigning a plain dict keeps in place changes to it visible
+        values = {'statsd': {'host': 'example.com'}}
+        config.CONFIG.config = values
+        self.assertEqual(config.get('statsd.host'), 'example.com')
+        values['statsd']['host'] = 'example.org'
+        self.assertEqual(config.get('statsd.host'), 'example.org')
+        self.assertTrue(config.CONFIG.config is values)
+
+    def test_patch_config(self):
+        # The pattern for tests documented in clay.asciidoc
+        original = config.CONFIG.config
+        config_copy = original.copy()
+        with mock.patch.object(config.CONFIG, 'config', config_copy):
+            config_copy['patched'] = True
+            self.assertEqual(config.get('patched'), True)
+            self.assertTrue(config.CONFIG.config is config_copy)
+        self.assertTrue(config.CONFIG.config is original)
+        self.assertEqual(config.get('patched'), None)
+
+    def test_feature_flag(self):
+        snapshot = config.CONFIG.publish({'features': {'foo': {'enabled': True}}})
+        self.assertTrue(snapshot.feature_flag('foo'))
+        self.assertFalse(snapshot.feature_flag('bar'))
+        self.assertTrue(config.feature_flag('foo'))
+
+
+class TestFeatureFlags(unittest.TestCase):
+    features = {
+        'on': {'enabled': True},
+        'off': {'enabled': False},
+        'half': {'percent': 50},
+        'none': {'percent': 0},
+        'all': {'percent': 100.0},
+        'invalid': {'percent': 'many'},
+        'scalar': True,
+    }
+
+    def setUp(self):
+        self.patch = mock.patch.dict(config.CONFIG.config, {'features': self.features})
+        self.patch.start()
+
+    def tearDown(self):
+        self.patch.stop()
+
+    def test_enabled(self):
+        self.assertTrue(config.feature_flag('on'))
+        self.assertFalse(config.feature_flag('off'))
+        self.assertFalse(config.feature_flag('missing'))
+        self.assertFalse(config.feature_flag('invalid'))
+        self.assertFalse(config.feature_flag('scalar'))
+
+    def test_percent(self):
+        with mock.patch('random.random', return_value=0.4):
+            self.assertTrue(config.feature_flag('half'))
+        with mock.patch('random.random', return_value=0.6):
+            self.assertFalse(config.feature_flag('half'))
+
+    def test_entity(self):
+        results = [config.feature_flag('half', user_id) for user_id in range(10000)]
+        self.assertTrue(4500 < sum(results) < 5500)
+        self.assertEqual(results, [config.feature_flag('half', user_id) for user_id in range(10000)])
+        self.assertEqual(config.feature_flag('half', 42), config.feature_flag('half', '42'))
+        self.assertFalse(any(config.feature_flag('none', user_id) for user_id in range(1000)))
+        self.assertTrue(all(config.feature_flag('all', user_id) for user_id in range(1000)))
+
+    def test_bulk(self):
+        flags = config.feature_flags(42)
+        self.assertEqual(set(flags), set(self.features))
+        self.assertEqual(flags['half'], config.feature_flag('half', 42))
+        self.assertEqual(config.feature_flags(42, ['on', 'missing']), {'on': True, 'missing': False})
+
+    def test_reload(self):
+        self.assertFalse(config.feature_flag('off'))
+        config.CONFIG.config['features'] = {'off': {'enabled': True}}
+        self.assertTrue(config.feature_flag('off'))
+
+
+class TestReload(unittest.TestCase):
+    def setUp(self):
+        self.wd = tempfile.mkdtemp()
+        self.path = os.path.join(self.wd, 'service.json')
+        self.write(self.path, {'statsd': {'host': '127.0.0.1'}, 'logging': {'version': 1}})
+        self.environ = mock.patch.dict(os.environ, {'CLAY_CONFIG': ''})
+        self.environ.start()
+        del os.environ['CLAY_CONFIG']
+
+        self.config = config.FileConfiguration()
+        self.config.paths = [self.path]
+        self.config.configure_logging = mock.Mock()
+        self.config.load()
+
+    def tearDown(self):
+        self.environ.stop()
+        shutil.rmtree(self.wd)
+
+    def write(self, path, values):
+        # Write to a new file and rename it into place, like most editors and
+        # deployment tools do.
+        with open(path + '.tmp', 'w') as fd:
+            json.dump(values, fd)
+        os.rename(path + '.tmp', path)
+
+    def test_unchanged(self):
+        with mock.patch.object(self.config, 'parse_file') as parse_file:
+            self.assertFalse(self.config.reload())
+            self.assertEqual(parse_file.call_count, 0)
+
+    def test_changed(self):
+        other = os.path.join(self.wd, 'other.json')
+        self.write(other, {'other': True})
+        self.config.paths.append(other)
+        self.assertTrue(self.config.reload())
+        self.assertEqual(self.config.get('other'), True)
+
+        self.write(self.path, {'statsd': {'host': 'example.com'}, 'logging': {'version': 1}})
+        with mock.patch.object(self.config, 'parse_file', wraps=self.config.parse_file) as parse_file:
+            self.assertTrue(self.config.reload())
+            parse_file.assert_called_once_with(self.path)
+        self.assertEqual(self.config.get('statsd.host'), 'example.com')
+        self.assertEqual(self.config.get('other'), True)
+        # Logging config didn't change so it should only have been configured by load()
+        self.assertEqual(self.config.configure_logging.call_count, 1)
+
+    def test_logging_changed(self):
+        self.write(self.path, {'logging': {'version': 1, 'root': {'level': 'INFO'}}})
+        self.assertTrue(self.config.reload())
+        self.config.configure_logging.assert_called_with({'version': 1, 'root': {'level': 'INFO'}})
+
+    def test_invalid(self):
+        with open(self.path, 'w') as fd:
+            fd.write('{"statsd": ')
+        self.assertFalse(self.config.reload())
+        self.assertEqual(self.config.get('statsd.host'), '127.0.0.1')
+
+    def wait_for(self, key, value, timeout=5.0):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.config.get(key) == value:
+                return True
+            time.sleep(0.01)
+        return False
+
+    def test_watch_inotify(self):
+        watcher = config.ConfigWatcher(self.config, interval=0.05)
+        watcher.start()
+        try:
+            self.write(self.path, {'statsd': {'host': 'example.com'}})
+            self.assertTrue(self.wait_for('statsd.host', 'example.com'))
+        finally:
+            watcher.stop()
+
+    def test_watch_inotify_partial_write(self):
+        watcher = config.ConfigWatcher(self.config, interval=0.05)
+        watcher.start()
+        try:
+            if watcher.inotify is None:
+                return
+            data = json.dumps({'statsd': {'host': 'example.com'}})
+            with mock.patch.object(self.config, 'reload', wraps=self.config.reload) as reload:
+                with open(self.path, 'w') as fd:
+                    fd.write(data[:10])
+                    fd.flush()
+                    time.sleep(0.3)
+                    # Not reloaded until the file is closed
+                    self.assertEqual(reload.call_count, 0)
+                    fd.write(data[10:])
+                self.assertTrue(self.wait_for('statsd.host', 'example.com'))
+        finally:
+            watcher.stop()
+
+    def test_watch_polling(self):
+        watcher = config.ConfigWatcher(self.config, interval=0.05, use_inotify=False)
+        watcher.start()
+        try:
+            self.assertTrue(watcher.inotify is None)
+            self.write(self.path, {'statsd': {'host': 'example.com'}})
+            self.assertTrue(self.wait_for('statsd.host', 'example.com'))
+        finally:
+            watcher.stop()
+
+
+class TestConfigCache(unittest.TestCase):
+    def setUp(self):
+        self.wd = tempfile.mkdtemp()
+        self.path = os.path.join(self.wd, 'service.json')
+        with open(self.path, 'w') as fd:
+            json.dump({'statsd': {'host': '127.0.0.1'}}, fd)
+        self.environ = mock.patch.dict(os.environ, {
+            'CLAY_CONFIG_CACHE_DIR': os.path.join(self.wd, 'cache'),
+        })
+        self.environ.start()
+
+    def tearDown(self):
+        self.environ.stop()
+        shutil.rmtree(self.wd)
+
+    def test_cache(self):
+        self.assertEqual(config.FileConfiguration().parse_file(self.path),
+                         {'statsd': {'host': '127.0.0.1'}})
+
+        conf = config.FileConfiguration()
+        with mock.patch('json.load') as load:
+            self.assertEqual(conf.parse_file(self.path), {'statsd': {'host': '127.0.0.1'}})
+            self.assertEqual(load.call_count, 0)
+
+    def test_changed(self):
+        config.FileConfiguration().parse_file(self.path)
+        with open(self.path, 'w') as fd:
+            json.dump({'statsd': {'host': 'example.com'}}, fd)
+        self.assertEqual(config.FileConfiguration().parse_file(self.path),
+                         {'statsd': {'host': 'example.com'}})
+
+    def test_unmarshallable(self):
+        cache = config.ConfigCache(os.path.join(self.wd, 'cache'))
+        cache.put(self.path, (1, 2, 3), {'value': object()})
+        self.assertEqual(cache.get(self.path, (1, 2, 3)), None)
+        self.assertFalse(os.path.exists(cache.filename(self.path)))
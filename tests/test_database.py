@@ -2,6 +2,11 @@ from __future__ import absolute_import
 import webtest.lint
 import webtest
 import threading
+import tempfile
+import shutil
+import sqlite3
+import time
+import mock
 import os
 
 os.environ['CLAY_CONFIG'] = 'config.json'
@@ -60,3 +65,403 @@ def test_database_threads():
 
     for t in threads:
         t.join()
+
+
+def make_pool(**kwargs):
+    connect = mock.Mock(side_effect=lambda: mock.Mock())
+    return database.ConnectionPool(connect, **kwargs)
+
+
+def test_pool_reuse():
+    pool = make_pool()
+    pooled = pool.checkout()
+    pool.checkin(pooled)
+    assert pool.checkout() is pooled
+    assert pool.connect.call_count == 1
+
+
+def test_pool_max_size():
+    pool = make_pool(max_size=2, checkout_timeout=0.05)
+    first = pool.checkout()
+    pool.checkout()
+    try:
+        pool.checkout()
+        assert False, 'Expected PoolTimeout'
+    except database.PoolTimeout:
+        pass
+
+    # A connection returned by another thread wakes up a waiting checkout
+    timer = threading.Timer(0.05, pool.checkin, (first,))
+    timer.start()
+    assert pool.checkout(timeout=5.0) is first
+    timer.join()
+
+
+def test_pool_idle_timeout():
+    pool = make_pool(min_size=1, idle_timeout=0.0)
+    first = pool.checkout()
+    second = pool.checkout()
+    pool.checkin(first)
+    pool.checkin(second)
+    # Only one idle connection is closed, to keep min_size open
+    assert pool.checkout() is second
+    assert first.connection.close.called
+    assert pool.size == 1
+
+
+def test_pool_max_lifetime():
+    pool = make_pool(max_lifetime=0.0)
+    pooled = pool.checkout()
+    pool.checkin(pooled)
+    assert pooled.connection.close.called
+    assert pool.checkout() is not pooled
+    assert pool.size == 1
+
+
+def test_pool_health_check():
+    pool = make_pool(health_check_interval=0.0)
+    pooled = pool.checkout()
+    pooled.connection.cursor.return_value.execute.side_effect = Exception('gone away')
+    pool.checkin(pooled)
+    assert pool.checkout() is not pooled
+    assert pooled.connection.close.called
+    assert pool.size == 1
+
+
+def test_pooled_context():
+    context = database.DatabaseContext([{'database': ':memory:'}], 'sqlite3', {'max_size': 1})
+    with context as db:
+        cur = db.cursor()
+        cur.execute('CREATE TABLE users (id INTEGER PRIMARY KEY NOT NULL)')
+        cur.close()
+        db.commit()
+        cur = db.cursor()
+        cur.execute('INSERT INTO users(id) VALUES(1)')
+        cur.close()
+
+    def other_thread():
+        # The uncommitted insert was rolled back when the connection was
+        # returned to the pool
+        with context as db:
+            cur = db.cursor()
+            cur.execute('SELECT COUNT(*) FROM users')
+            result.append(cur.fetchone()[0])
+            cur.close()
+
+    result = []
+    t = threading.Thread(target=other_thread)
+    t.start()
+    t.join()
+    assert result == [0]
+
+
+def test_failover():
+    bad = {'database': '/nonexistent/claytest.db'}
+    good = {'database': ':memory:'}
+    context = database.DatabaseContext([bad, good], 'sqlite3')
+    for i in range(10):
+        with context as db:
+            db.cursor().close()
+
+    bad_health, good_health = context.health
+    assert bad_health.failures == 1
+    assert bad_health.retry_at > time.time()
+    assert good_health.failures == 0
+    assert good_health.connect_latency is not None
+    # Connecting is not a query
+    assert good_health.latency is None
+
+
+def test_record_latency():
+    context = database.DatabaseContext([{'database': ':memory:'}], 'sqlite3',
+                                       pool={'max_size': 1})
+    with context as db:
+        # Without instrumentation, the driver's own connection is returned
+        assert isinstance(db, sqlite3.Connection)
+        cur = db.cursor()
+        cur.execute('SELECT 1')
+        cur.close()
+
+    # Sampled from the rollback when the connection was returned to the pool
+    health = context.health[0]
+    assert health.latency is not None
+    assert health.connect_latency is not None
+    assert health.checkout_latency is not None
+    assert health.score() == health.latency + health.checkout_latency
+
+
+def test_all_servers_failing():
+    context = database.DatabaseContext([{'database': '/nonexistent/claytest.db'}], 'sqlite3')
+    for i in range(2):
+        try:
+            with context:
+                pass
+            assert False, 'Expected OperationalError'
+        except sqlite3.OperationalError:
+            pass
+    assert context.health[0].failures == 2
+
+
+def test_probe_after_cooldown():
+    context = database.DatabaseContext([{'database': ':memory:'}] * 2, 'sqlite3')
+    first, second = context.health
+    first.record_latency(0.001)
+    second.record_failure(time.time() - database.FAILURE_COOLDOWN)
+    # The failed server is probed once its cooldown has passed
+    assert context.choose() is second
+    # ...but only by one thread at a time
+    assert context.choose() is first
+
+
+def test_prefer_fast_server():
+    context = database.DatabaseContext([{'database': ':memory:'}] * 2, 'sqlite3')
+    fast, slow = context.health
+    fast.record_latency(0.001)
+    slow.record_latency(0.1)
+    for i in range(10):
+        assert context.choose() is fast
+
+
+def test_wrapped_connection_context():
+    context = database.DatabaseContext([{'database': ':memory:'}], 'sqlite3',
+                                       pool={'max_size': 1},
+                                       instrument={'slow_query_ms': None})
+    with context as db:
+        assert isinstance(db, database.InstrumentedConnection)
+        db.cursor().execute('CREATE TABLE users (id INTEGER PRIMARY KEY)')
+        with db as conn:
+            assert conn is db
+            conn.cursor().execute('INSERT INTO users (id) VALUES (1)')
+        # Committed by the connection's own context manager, so it survives
+        # the rollback when the connection is returned to the pool
+    with context as db:
+        cur = db.cursor()
+        cur.execute('SELECT COUNT(*) FROM users')
+        assert cur.fetchone() == (1,)
+        cur.close()
+
+
+def test_wrapped_cursor_setattr():
+    raw = mock.MagicMock()
+    cur = database.InstrumentedCursor(raw, None, database.ServerHealth({}))
+    cur.itersize = 100
+    assert raw.itersize == 100
+    assert 'itersize' not in vars(cur)
+    with cur as entered:
+        assert entered is cur
+    raw.__enter__.assert_called_once_with()
+    raw.__exit__.assert_called_once_with(None, None, None)
+
+
+@mock.patch('clay.stats.counter')
+@mock.patch('clay.stats.timer')
+def test_instrumentation(mock_timer, mock_counter):
+    mock_timer.side_effect = lambda key: mock.Mock(key=key)
+    mock_counter.side_effect = lambda key: mock.Mock(key=key)
+    context = database.DatabaseContext([{'database': ':memory:'}], 'sqlite3',
+                                       pool={'max_size': 1}, name='read',
+                                       instrument={'slow_query_ms': 0})
+    instrumentation = context.instrumentation
+    assert instrumentation.execute.key == 'clay.database.read.execute'
+
+    with mock.patch.object(database.log, 'warning') as warning:
+        with context as db:
+            cur = db.cursor()
+            cur.execute('SELECT 1 UNION SELECT 2 UNION SELECT ?', (3,))
+            assert cur.fetchone() == (1,)
+            assert list(cur) == [(2,), (3,)]
+            cur.close()
+        warning.assert_called_once_with(mock.ANY)
+        assert 'SELECT ? UNION SELECT ? UNION SELECT ?' in warning.call_args[0][0]
+
+    assert instrumentation.connect.record.call_count == 1
+    assert instrumentation.checkout_wait.record.call_count == 1
+    assert instrumentation.execute.record.call_count == 1
+    assert instrumentation.slow_queries.incr.call_count == 1
+    assert instrumentation.rows.incr.call_args_list == [mock.call(3)]
+
+
+def test_normalize_sql():
+    sql = database.normalize_sql('''
+        SELECT * FROM users2
+        WHERE id IN (1, 2, 3) AND email = 'a''b' AND score > 1.5 AND name = %s''')
+    assert sql == 'SELECT * FROM users2 WHERE id IN (?) AND email = ? AND score > ? AND name = %s'
+
+
+def test_nested_context():
+    context = database.DatabaseContext([{'database': ':memory:'}], 'sqlite3')
+    assert 'not connected' in str(context)
+    with context as outer:
+        with context as inner:
+            assert inner is outer
+            assert '(connected)' in str(context)
+        # Leaving the inner block doesn't close the connection
+        outer.cursor().close()
+    assert 'not connected' in str(context)
+    assert context.dbconn is None
+
+
+def test_nested_context_exception():
+    context = database.DatabaseContext([{'database': ':memory:'}], 'sqlite3')
+    try:
+        with context:
+            with context:
+                raise ValueError('inner')
+    except ValueError as e:
+        assert str(e) == 'inner'
+    else:
+        assert False, 'Expected ValueError'
+    assert context.dbconn is None
+
+
+def test_context_per_thread():
+    context = database.DatabaseContext([{'database': ':memory:'}], 'sqlite3')
+    entered = threading.Event()
+    done = threading.Event()
+    connections = []
+
+    def other_thread():
+        assert context.dbconn is None
+        with context as db:
+            connections.append(db)
+            entered.set()
+            done.wait(5.0)
+
+    t = threading.Thread(target=other_thread)
+    t.start()
+    entered.wait(5.0)
+    with context as db:
+        assert db is not connections[0]
+    done.set()
+    t.join()
+
+
+def test_stream():
+    wd = tempfile.mkdtemp()
+    try:
+        context = database.DatabaseContext([{'database': os.path.join(wd, 'stream.db')}], 'sqlite3')
+        with context as db:
+            db.cursor().execute('CREATE TABLE numbers (n INTEGER NOT NULL)')
+
+        count = context.bulk_insert('INSERT INTO numbers(n) VALUES(?)',
+                                    ((i,) for i in xrange(2500)), chunk_size=1000)
+        assert count == 2500
+
+        batches = list(context.stream_batches('SELECT n FROM numbers ORDER BY n', batch_size=1000))
+        assert [len(rows) for rows in batches] == [1000, 1000, 500]
+
+        rows = context.stream('SELECT n FROM numbers WHERE n < ? ORDER BY n', (10,), batch_size=3)
+        assert [row[0] for row in rows] == range(10)
+
+        # Closing a generator early releases the connection
+        rows = context.stream('SELECT n FROM numbers')
+        next(rows)
+        assert context.dbconn is not None
+        rows.close()
+        assert context.dbconn is None
+    finally:
+        shutil.rmtree(wd)
+
+
+def test_statement_cache():
+    cursor = mock.Mock()
+    cursor.connection.autocommit = False
+    conn = database.PreparedConnection(mock.Mock(), database.StatementCache(2))
+    conn.connection.cursor.return_value = cursor
+    cur = conn.cursor()
+
+    cur.execute('SELECT * FROM users WHERE id = %s AND email LIKE \'%%@uber.com\'', (1,))
+    cur.execute('SELECT * FROM users WHERE id = %s AND email LIKE \'%%@uber.com\'', (2,))
+    assert cursor.execute.call_args_list == [
+        mock.call('SAVEPOINT clay_prepare'),
+        mock.call('PREPARE clay_stmt_0 AS SELECT * FROM users WHERE id = $1 AND email LIKE \'%@uber.com\''),
+        mock.call('RELEASE SAVEPOINT clay_prepare'),
+        mock.call('EXECUTE clay_stmt_0 (%s)', (1,)),
+        mock.call('EXECUTE clay_stmt_0 (%s)', (2,)),
+    ]
+
+    # Statements with named parameters, and DDL, aren't prepared
+    cursor.reset_mock()
+    cur.execute('SELECT * FROM users WHERE id = %(id)s', {'id': 1})
+    cur.execute('CREATE TABLE foo (id INTEGER)', ())
+    assert cursor.execute.call_args_list == [
+        mock.call('SELECT * FROM users WHERE id = %(id)s', {'id': 1}),
+        mock.call('CREATE TABLE foo (id INTEGER)', ()),
+    ]
+
+    # The least recently used statement is deallocated
+    cursor.reset_mock()
+    # Outside a transaction, PREPARE needs no savepoint
+    cursor.connection.autocommit = True
+    cur.executemany('INSERT INTO users(email) VALUES(%s)', [('a',), ('b',)])
+    cur.execute('DELETE FROM users', ())
+    assert cursor.execute.call_args_list == [
+        mock.call('PREPARE clay_stmt_1 AS INSERT INTO users(email) VALUES($1)'),
+        mock.call('PREPARE clay_stmt_2 AS DELETE FROM users'),
+        mock.call('DEALLOCATE clay_stmt_0'),
+        mock.call('EXECUTE clay_stmt_2', ()),
+    ]
+    cursor.executemany.assert_called_once_with('EXECUTE clay_stmt_1 (%s)', [('a',), ('b',)])
+
+
+def test_statement_cache_container_params():
+    cursor = mock.Mock()
+    cur = database.PreparedCursor(cursor, database.StatementCache(2))
+    # psycopg2 expands these into IN lists, arrays and hstores, which can't
+    # be bound to a single prepared parameter
+    cur.execute('SELECT * FROM users WHERE id IN %s', ((1, 2, 3),))
+    cur.execute('SELECT * FROM users WHERE id = ANY(%s)', ([1, 2, 3],))
+    cur.executemany('UPDATE users SET attrs = %s WHERE id = %s', [({'a': 'b'}, 1)])
+    assert cursor.execute.call_args_list == [
+        mock.call('SELECT * FROM users WHERE id IN %s', ((1, 2, 3),)),
+        mock.call('SELECT * FROM users WHERE id = ANY(%s)', ([1, 2, 3],)),
+    ]
+    cursor.executemany.assert_called_once_with(
+        'UPDATE users SET attrs = %s WHERE id = %s', [({'a': 'b'}, 1)])
+
+
+def test_statement_cache_prepare_fails():
+    def execute(sql, *args):
+        if sql.startswith('PREPARE'):
+            raise Exception('could not determine data type of parameter $1')
+    cursor = mock.Mock()
+    cursor.connection.autocommit = False
+    cursor.execute.side_effect = execute
+    cur = database.PreparedCursor(cursor, database.StatementCache(2))
+
+    with mock.patch.object(database.log, 'warning') as warning:
+        cur.execute('SELECT %s', (1,))
+        cur.execute('SELECT %s', (2,))
+    warning.assert_called_once_with(mock.ANY)
+    # The failed PREPARE is rolled back without aborting the transaction,
+    # the statement runs unprepared, and isn't prepared again
+    assert cursor.execute.call_args_list == [
+        mock.call('SAVEPOINT clay_prepare'),
+        mock.call('PREPARE clay_stmt_0 AS SELECT $1'),
+        mock.call('ROLLBACK TO SAVEPOINT clay_prepare'),
+        mock.call('SELECT %s', (1,)),
+        mock.call('SELECT %s', (2,)),
+    ]
+
+
+def test_prepared_wrappers_forward():
+    raw = mock.MagicMock()
+    conn = database.PreparedConnection(raw, database.StatementCache(2))
+    with conn as entered:
+        assert entered is conn
+    raw.__exit__.assert_called_once_with(None, None, None)
+    conn.autocommit = True
+    assert raw.autocommit is True
+
+    cur = conn.cursor()
+    cur.itersize = 100
+    assert raw.cursor.return_value.itersize == 100
+    assert 'itersize' not in vars(cur)
+
+
+def test_statement_cache_sqlite():
+    context = database.DatabaseContext([{'database': ':memory:'}], 'sqlite3', statement_cache=50)
+    with mock.patch.object(context.dbapi, 'connect') as connect:
+        with context:
+            pass
+        connect.assert_called_once_with(database=':memory:', cached_statements=50)
@@ -0,0 +1,473 @@
+from __future__ import absolute_import
+
+from datetime import datetime
+import tempfile
+import threading
+import unittest
+import logging
+import shutil
+import time
+import sys
+import socket
+import json
+import mock
+import os
+
+os.environ['CLAY_CONFIG'] = 'config.json'
+
+from clay import config, logger, logforwarder, logreceiver
+log = config.get_logger('clay.tests.logger')
+
+
+def make_record(msg, level=logging.INFO, name='clay.tests.logger'):
+    return logging.LogRecord(name, level, __file__, 1, msg, (), None)
+
+
+class TestRecordEncoder(unittest.TestCase):
+    def test_encode(self):
+        encoder = logger.RecordEncoder(hostname='testhost', json_module='json')
+        record = make_record('hello %s')
+        record.args = ('world',)
+        event = json.loads(encoder.encode(record))
+        self.assertEqual(event, {
+            '@source_host': 'testhost',
+            '@timestamp': datetime.utcfromtimestamp(record.created).isoformat(),
+            '@tags': ['clay.tests.logger'],
+            '@message': 'hello world',
+            '@fields': {
+                'level': 'INFO',
+                'filename': __file__,
+                'lineno': 1,
+                'method': None,
+            },
+        })
+
+    def test_exception(self):
+        encoder = logger.RecordEncoder()
+        try:
+            raise ValueError('oops')
+        except ValueError:
+            record = logging.LogRecord('clay.tests.logger', logging.ERROR,
+                                       __file__, 1, 'failed', (), sys.exc_info())
+        fields = json.loads(encoder.encode(record))['@fields']
+        self.assertIn('ValueError: oops', fields['traceback'])
+        self.assertIn('ValueError', fields['exception'])
+
+    def test_timestamp(self):
+        encoder = logger.RecordEncoder()
+        for created in (1400000000.0, 1400000000.25, 1400000000.9999996,
+                        1400000001.5, 1400000000.000001):
+            self.assertEqual(encoder.timestamp(created),
+                             datetime.utcfromtimestamp(created).isoformat())
+
+
+class TestDiskSpool(unittest.TestCase):
+    def setUp(self):
+        self.wd = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.wd)
+
+    def test_read_commit(self):
+        spool = logger.DiskSpool(self.wd, segment_bytes=12)
+        for i in range(4):
+            spool.write('line %i\n' % i)
+        self.assertEqual(spool.size, 28)
+        self.assertEqual(len(spool.segments), 4)
+
+        token, data = spool.read(1024)
+        self.assertEqual(data, 'line 0\n')
+        self.assertEqual(spool.read(1024)[1], 'line 0\n')
+        spool.commit(token)
+        self.assertEqual(spool.read(1024)[1], 'line 1\n')
+        self.assertEqual(spool.size, 21)
+
+    def test_partial_read(self):
+        spool = logger.DiskSpool(self.wd)
+        spool.write('aaaa\nbbbb\ncccc\n')
+        token, data = spool.read(6)
+        self.assertEqual(data, 'aaaa\nbbbb\n')
+        spool.commit(token)
+        token, data = spool.read(6)
+        self.assertEqual(data, 'cccc\n')
+        spool.commit(token)
+        self.assertEqual(spool.read(6), None)
+        self.assertEqual(spool.size, 0)
+        self.assertEqual(os.listdir(self.wd), [])
+
+    def test_max_bytes(self):
+        spool = logger.DiskSpool(self.wd, segment_bytes=7, max_bytes=21)
+        for i in range(5):
+            spool.write('line %i\n' % i)
+        self.assertEqual(spool.size, 21)
+        self.assertEqual(spool.read(1024)[1], 'line 2\n')
+
+    def test_reopen(self):
+        spool = logger.DiskSpool(self.wd)
+        spool.write('line 0\n')
+        spool = logger.DiskSpool(self.wd)
+        spool.write('line 1\n')
+        self.assertEqual(spool.read(1024)[1], 'line 0\n')
+
+    def test_write_during_read(self):
+        # write() must not wait for read() to finish reading from disk
+        spool = logger.DiskSpool(self.wd, segment_bytes=7, max_bytes=14)
+        spool.write('line 0\n')
+        writer = threading.Thread(target=spool.write, args=('line 1\n',))
+
+        def slow_open(*args):
+            writer.start()
+            writer.join(1.0)
+            return open(*args)
+
+        with mock.patch('clay.logger.open', side_effect=slow_open, create=True):
+            self.assertEqual(spool.read(1024)[1], 'line 0\n')
+        self.assertFalse(writer.is_alive())
+        self.assertEqual(spool.size, 14)
+
+    def test_removed_during_read(self):
+        spool = logger.DiskSpool(self.wd, segment_bytes=7, max_bytes=14)
+        spool.write('line 0\n')
+        spool.write('line 1\n')
+
+        def full_open(*args):
+            # Fill the spool so that write() discards the segment being read
+            mock_open.side_effect = open
+            spool.write('line 2\n')
+            return open(*args)
+
+        with mock.patch('clay.logger.open', side_effect=full_open, create=True) as mock_open:
+            self.assertEqual(spool.read(1024)[1], 'line 1\n')
+
+
+class MockTCPServer(object):
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(1)
+        self.port = self.sock.getsockname()[1]
+        self.accepted = None
+        self.buf = ''
+
+    def readline(self):
+        if not self.accepted:
+            self.accepted, addr = self.sock.accept()
+        while self.buf.find('\n') == -1:
+            self.buf += self.accepted.recv(4096)
+        line, self.buf = self.buf.split('\n', 1)
+        return line
+
+    def close(self):
+        if self.accepted:
+            self.accepted.close()
+        self.sock.close()
+
+
+class TestTCPHandler(unittest.TestCase):
+    def setUp(self):
+        self.server = MockTCPServer()
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_emit(self):
+        handler = logger.TCPHandler('127.0.0.1', self.server.port)
+        handler.emit(make_record('hello'))
+        event = json.loads(self.server.readline())
+        self.assertEqual(event['@message'], 'hello')
+        self.assertEqual(event['@tags'], ['clay.tests.logger'])
+        self.assertEqual(event['@fields']['level'], 'INFO')
+        handler.close()
+
+    @mock.patch('threading.Thread')
+    def test_get_batch(self, mock_thread):
+        handler = logger.TCPHandler('127.0.0.1', self.server.port, batch_records=3)
+        for i in range(5):
+            handler.emit(make_record('message %i' % i))
+
+        records, data, running = handler.get_batch()
+        self.assertTrue(running)
+        self.assertEqual(len(records), 3)
+        lines = data.splitlines()
+        self.assertEqual([json.loads(line)['@message'] for line in lines],
+                         ['message 0', 'message 1', 'message 2'])
+
+        handler.queue.put(None)
+        records, data, running = handler.get_batch()
+        self.assertFalse(running)
+        self.assertEqual(len(records), 2)
+
+    @mock.patch('threading.Thread')
+    def test_overflow_drop_newest(self, mock_thread):
+        handler = logger.TCPHandler('127.0.0.1', self.server.port, queue_size=2)
+        for i in range(4):
+            handler.emit(make_record('message %i' % i))
+        self.assertEqual(handler.dropped, 2)
+        self.assertEqual([r.getMessage() for r in handler.queue.queue],
+                         ['message 0', 'message 1'])
+
+    @mock.patch('threading.Thread')
+    def test_overflow_drop_oldest(self, mock_thread):
+        handler = logger.TCPHandler('127.0.0.1', self.server.port, queue_size=2,
+                                    overflow='drop_oldest')
+        for i in range(4):
+            handler.emit(make_record('message %i' % i))
+        self.assertEqual(handler.dropped, 2)
+        self.assertEqual([r.getMessage() for r in handler.queue.queue],
+                         ['message 2', 'message 3'])
+
+    @mock.patch('threading.Thread')
+    def test_overflow_after_close(self, mock_thread):
+        handler = logger.TCPHandler('127.0.0.1', self.server.port, queue_size=1,
+                                    overflow='drop_oldest')
+        handler.close()
+        # Records logged after close() must not evict the sentinel
+        handler.emit(make_record('late', level=logging.ERROR))
+        self.assertEqual(handler.dropped, 1)
+        self.assertEqual(list(handler.queue.queue), [None])
+
+    @mock.patch('threading.Thread')
+    def test_overflow_drop_by_level(self, mock_thread):
+        handler = logger.TCPHandler('127.0.0.1', self.server.port, queue_size=2,
+                                    overflow='drop_by_level', overflow_level='ERROR')
+        handler.emit(make_record('info 0'))
+        handler.emit(make_record('info 1'))
+        handler.emit(make_record('info 2'))
+        handler.emit(make_record('error', level=logging.ERROR))
+        self.assertEqual(handler.dropped, 2)
+        self.assertEqual([r.getMessage() for r in handler.queue.queue],
+                         ['info 1', 'error'])
+
+    @mock.patch('threading.Thread')
+    def test_report_stats(self, mock_thread):
+        handler = logger.TCPHandler('127.0.0.1', self.server.port, stats_prefix='logs')
+        handler.dropped = 3
+        handler.send_latency = 1.5
+        with mock.patch('clay.stats.count') as mock_count:
+            with mock.patch('clay.stats.gauge') as mock_gauge:
+                with mock.patch('clay.stats.timing') as mock_timing:
+                    handler.report_stats()
+        mock_gauge.assert_called_once_with('logs.queue_depth', 0)
+        mock_count.assert_called_once_with('logs.dropped', 3)
+        mock_timing.assert_called_once_with('logs.send_latency', 1.5)
+        handler.close()
+
+    @mock.patch('threading.Thread')
+    def test_report_stats_while_down(self, mock_thread):
+        handler = logger.TCPHandler('127.0.0.1', self.server.port, stats_prefix='logs')
+        handler.connect = mock.Mock()
+        handler.sock = mock.Mock()
+        handler.send = mock.Mock(side_effect=[socket.error('down'), socket.error('down'), None])
+        handler.report_stats = mock.Mock()
+        handler.emit(make_record('hello'))
+        handler.queue.put(None)
+        handler.run()
+        # Once per pass: before each of the two failed sends and the
+        # successful one
+        self.assertEqual(handler.report_stats.call_count, 3)
+
+    @mock.patch.object(logger, 'STATS_INTERVAL', 0.05)
+    def test_report_stats_while_idle(self):
+        with mock.patch.object(logger.TCPHandler, 'report_stats') as report_stats:
+            handler = logger.TCPHandler('127.0.0.1', self.server.port, stats_prefix='logs')
+            time.sleep(0.3)
+            self.assertTrue(report_stats.call_count >= 2)
+            handler.close()
+
+    def test_compression(self):
+        for compression in ('zlib', 'gzip'):
+            server = MockTCPServer()
+            handler = logger.TCPHandler('127.0.0.1', server.port, compression=compression)
+            handler.emit(make_record('hello'))
+            handler.emit(make_record('world'))
+            server.accepted, addr = server.sock.accept()
+            frames = logreceiver.read_frames(server.accepted, compression)
+            lines = []
+            while len(lines) < 2:
+                lines.extend(next(frames).splitlines())
+            self.assertEqual([json.loads(line)['@message'] for line in lines],
+                             ['hello', 'world'])
+            handler.close()
+            server.close()
+
+    @mock.patch('threading.Thread')
+    def test_overflow_spool(self, mock_thread):
+        wd = tempfile.mkdtemp()
+        try:
+            handler = logger.TCPHandler('127.0.0.1', self.server.port, queue_size=1,
+                                        spool_dir=wd)
+            handler.emit(make_record('queued'))
+            handler.emit(make_record('spooled'))
+            self.assertEqual(handler.dropped, 0)
+            token, data = handler.spool.read(1024)
+            self.assertEqual(json.loads(data)['@message'], 'spooled')
+        finally:
+            shutil.rmtree(wd)
+
+    def test_spool_replay(self):
+        wd = tempfile.mkdtemp()
+        try:
+            spool = logger.DiskSpool(wd)
+            spool.write('%s\n' % logger.RecordEncoder().encode(make_record('spooled')))
+            handler = logger.TCPHandler('127.0.0.1', self.server.port, spool_dir=wd)
+            self.assertEqual(json.loads(self.server.readline())['@message'], 'spooled')
+            handler.emit(make_record('queued'))
+            self.assertEqual(json.loads(self.server.readline())['@message'], 'queued')
+            handler.close()
+        finally:
+            shutil.rmtree(wd)
+
+
+class TestUDPHandler(unittest.TestCase):
+    def setUp(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.settimeout(1.0)
+        self.port = self.server.getsockname()[1]
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_emit(self):
+        handler = logger.UDPHandler('127.0.0.1', self.port)
+        handler.emit(make_record('hello'))
+        data = self.server.recv(65536)
+        self.assertEqual(json.loads(data)['@message'], 'hello')
+        handler.close()
+
+    def test_no_limit_unqueued(self):
+        handler = logger.UDPHandler('127.0.0.1', self.port)
+        handler.emit(make_record('x' * 5000))
+        data = self.server.recv(65536)
+        self.assertEqual(json.loads(data)['@message'], 'x' * 5000)
+        self.assertEqual(handler.truncated, 0)
+        handler.close()
+
+    def test_truncate(self):
+        handler = logger.UDPHandler('127.0.0.1', self.port, max_payload=512)
+        handler.emit(make_record('x' * 2000))
+        data = self.server.recv(65536)
+        self.assertTrue(len(data) <= 512)
+        event = json.loads(data)
+        self.assertTrue(event['@message'].endswith(logger.TRUNCATED_MARKER))
+        self.assertTrue(event['@fields']['truncated'])
+        self.assertEqual(handler.truncated, 1)
+        handler.close()
+
+    def test_truncate_traceback(self):
+        try:
+            raise ValueError('y' * 2000)
+        except ValueError:
+            record = make_record('hello')
+            record.exc_info = sys.exc_info()
+        event = logger.RecordEncoder().encode_truncated(record, 1024)
+        self.assertTrue(len(event) < 1024)
+        event = json.loads(event)
+        self.assertEqual(event['@message'], 'hello')
+        self.assertTrue(event['@fields']['traceback'].endswith(logger.TRUNCATED_MARKER))
+
+    def test_truncate_non_ascii(self):
+        record = make_record('caf\xc3\xa9 ' * 300)
+        for json_module in ('json', 'simplejson'):
+            encoder = logger.RecordEncoder(json_module=json_module)
+            for max_size in range(400, 600, 7):
+                event = encoder.encode_truncated(record, max_size)
+                # Fills the space up to one escaped character short
+                self.assertTrue(max_size - 7 <= len(event) + 1 <= max_size)
+                message = json.loads(event)['@message']
+                self.assertTrue(message.startswith(u'caf\xe9 caf\xe9 '))
+                self.assertTrue(message.endswith(logger.TRUNCATED_MARKER))
+
+    def test_oversize_drop(self):
+        handler = logger.UDPHandler('127.0.0.1', self.port, max_payload=512,
+                                    oversize=logger.OVERSIZE_DROP)
+        handler.emit(make_record('x' * 2000))
+        handler.emit(make_record('hello'))
+        data = self.server.recv(65536)
+        self.assertEqual(json.loads(data)['@message'], 'hello')
+        self.assertEqual(handler.dropped, 1)
+        handler.close()
+
+    @mock.patch('threading.Thread')
+    def test_coalesce(self, mock_thread):
+        handler = logger.UDPHandler('127.0.0.1', self.port, queued=True, max_payload=1024)
+        mock_thread.return_value.join.side_effect = lambda timeout: handler.run()
+        for i in range(10):
+            handler.emit(make_record('message %d' % i))
+        handler.close()
+
+        messages = []
+        datagrams = 0
+        coalesced = 0
+        while len(messages) < 10:
+            data = self.server.recv(65536)
+            self.assertTrue(len(data) <= 1024)
+            datagrams += 1
+            lines = data.splitlines()
+            if len(lines) > 1:
+                coalesced += len(lines)
+            messages.extend(json.loads(line)['@message'] for line in lines)
+        self.assertEqual(messages, ['message %d' % i for i in range(10)])
+        self.assertTrue(datagrams < 10)
+        self.assertEqual(handler.coalesced, coalesced)
+
+    @mock.patch('threading.Thread')
+    def test_serialize_error_dropped(self, mock_thread):
+        handler = logger.UDPHandler('127.0.0.1', self.port, queued=True)
+        mock_thread.return_value.join.side_effect = lambda timeout: handler.run()
+        handler.emit(make_record('hello'))
+        with mock.patch.object(handler, 'serialize', side_effect=ValueError):
+            handler.close()
+        self.assertEqual(handler.dropped, 1)
+
+    def test_close_drains_queue(self):
+        handler = logger.UDPHandler('127.0.0.1', self.port, queued=True)
+        sender = handler.sender
+        handler.emit(make_record('hello'))
+        handler.close()
+        self.assertFalse(sender.is_alive())
+        self.assertEqual(json.loads(self.server.recv(65536))['@message'], 'hello')
+
+    @mock.patch('threading.Thread')
+    def test_queue_full(self, mock_thread):
+        handler = logger.UDPHandler('127.0.0.1', self.port, queued=True, queue_size=1)
+        handler.emit(make_record('a'))
+        handler.emit(make_record('b'))
+        self.assertEqual(handler.dropped, 1)
+
+
+class TestUnixHandler(unittest.TestCase):
+    def setUp(self):
+        self.wd = tempfile.mkdtemp()
+        self.path = os.path.join(self.wd, 'forwarder.sock')
+
+    def tearDown(self):
+        shutil.rmtree(self.wd)
+
+    def test_forward(self):
+        upstream = mock.Mock()
+        forwarder = logforwarder.LogForwarder(self.path, upstream)
+        forwarder.bind()
+
+        handler = logger.UnixHandler(self.path)
+        handler.emit(make_record('hello'))
+        data = forwarder.sock.recv(logforwarder.MAX_DATAGRAM_SIZE)
+        self.assertTrue(data.endswith('\n'))
+        self.assertEqual(json.loads(data)['@message'], 'hello')
+        handler.close()
+        forwarder.close()
+
+    def test_forwarder_not_running(self):
+        handler = logger.UnixHandler(self.path)
+        handler.emit(make_record('hello'))
+        self.assertEqual(handler.dropped, 1)
+        handler.close()
+
+    @mock.patch('threading.Thread')
+    def test_tcp_forward(self, mock_thread):
+        handler = logger.TCPHandler('127.0.0.1', 0)
+        handler.forward('{"@message": "a"}\n{"@message": "b"}\n')
+        handler.emit(make_record('c'))
+        records, data, running = handler.get_batch()
+        self.assertEqual([json.loads(line)['@message'] for line in data.splitlines()],
+                         ['a', 'b', 'c'])
@@ -1,7 +1,10 @@
 from __future__ import absolute_import
 
+import threading
+import time
 import unittest
 import socket
+import mock
 import os.path
 import os
 import re
@@ -59,11 +62,27 @@ class TestStats(unittest.TestCase):
         line = mockserver.readline()
         self.assertEqual(line, 'foo:1|c')
 
-    def test_count_sample(self):
+    @mock.patch('random.random', return_value=0.25)
+    def test_count_sample(self, mock_random):
         stats.count('foo', 1, 0.5)
         line = mockserver.readline()
         self.assertEqual(line, 'foo:1|c|@0.500000')
 
+    @mock.patch('random.random', return_value=0.75)
+    def test_count_sample_rejected(self, mock_random):
+        with mock.patch.object(stats.connection, 'send') as mock_send:
+            self.assertTrue(stats.count('foo', 1, 0.5))
+            self.assertTrue(stats.timing('foo', 1.0, 0.5))
+            self.assertFalse(mock_send.called)
+
+    @mock.patch('random.random', return_value=0.05)
+    def test_sample_rates(self, mock_random):
+        with mock.patch.dict(stats.sample_rates, {'foo': 0.1}):
+            stats.timing('foo', 10.5)
+            stats.counter('foo').incr()
+        lines = [mockserver.readline() for i in range(2)]
+        self.assertEqual(lines, ['foo:10.500000|ms|@0.100000', 'foo:1|c|@0.100000'])
+
     def test_timing(self):
         stats.timing('foo', 10.5)
         line = mockserver.readline()
@@ -90,3 +109,230 @@ class TestStats(unittest.TestCase):
         self.assertIn('foo.calls:1|c', lines)
         self.assertNotIn('foo.exceptions:1|c', lines)
         self.assertEqual(len([x for x in lines if re.match('^foo.duration:[0-9\.]+|ms$', x)]), 1)
+
+    def test_counter(self):
+        calls = stats.counter('foo')
+        calls.incr()
+        calls.incr(5)
+        calls.decr()
+        lines = [mockserver.readline() for i in range(3)]
+        self.assertEqual(lines, ['foo:1|c', 'foo:5|c', 'foo:-1|c'])
+
+    def test_timer(self):
+        duration = stats.timer('foo')
+        duration.record(10.5)
+        with duration.time():
+            pass
+        lines = [mockserver.readline() for i in range(2)]
+        self.assertEqual(lines[0], 'foo:10.500000|ms')
+        self.assertNotEqual(re.match('^foo:[0-9\.]+|ms$', lines[1]), None)
+
+
+class TestBufferedStats(unittest.TestCase):
+    def setUp(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.config = {
+            'statsd': {
+                'protocol': 'udp',
+                'host': '127.0.0.1',
+                'port': self.server.getsockname()[1],
+                'buffered': True,
+                'max_packet_size': 32,
+            }
+        }
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_flush(self):
+        with mock.patch.dict(config.CONFIG.config, self.config):
+            conn = stats.StatsConnection()
+            self.assertTrue(conn.send('foo:1|c'))
+            self.assertTrue(conn.send('bar:1|c'))
+            self.assertTrue(conn.flush())
+        self.assertEqual(self.server.recv(1024), 'foo:1|c\nbar:1|c\n')
+
+    def test_flush_when_full(self):
+        with mock.patch.dict(config.CONFIG.config, self.config):
+            conn = stats.StatsConnection()
+            for i in range(5):
+                conn.send('foo:%i|c' % i)
+            self.assertEqual(self.server.recv(1024), 'foo:0|c\nfoo:1|c\nfoo:2|c\nfoo:3|c\n')
+            conn.flush()
+        self.assertEqual(self.server.recv(1024), 'foo:4|c\n')
+
+    @mock.patch('threading.Thread')
+    def test_flusher_restart_after_fork(self, mock_thread):
+        flusher = stats.Flusher()
+        flusher.register(mock.Mock())
+        flusher.check()
+        self.assertEqual(mock_thread.return_value.start.call_count, 1)
+        # The flusher thread doesn't survive fork(), so the child starts one
+        with mock.patch('os.getpid', return_value=os.getpid() + 1):
+            flusher.check()
+            flusher.check()
+        self.assertEqual(mock_thread.return_value.start.call_count, 2)
+
+
+class TestAggregator(unittest.TestCase):
+    def setUp(self):
+        self.conn = mock.Mock()
+        self.conn.max_packet_size = 32
+        self.aggregator = stats.Aggregator(self.conn)
+
+    def sent(self):
+        return [args[0] for args, kwargs in self.conn.send.call_args_list]
+
+    def test_count(self):
+        for i in range(100):
+            self.aggregator.count('foo', 1)
+        self.aggregator.count('bar', 0.5)
+        self.aggregator.flush()
+        self.assertEqual(sorted(self.sent()), ['bar:0.500000|c', 'foo:100|c'])
+        self.conn.flush.assert_called_once_with()
+
+    def test_gauge(self):
+        self.aggregator.gauge('foo', 1.0)
+        self.aggregator.gauge('foo', 2.0)
+        self.aggregator.flush()
+        self.assertEqual(self.sent(), ['foo:2.000000|g'])
+
+    def test_unique_set(self):
+        for value in ('a', 'b', 'a', 'a'):
+            self.aggregator.unique_set('foo', value)
+        self.aggregator.flush()
+        self.assertEqual(sorted(self.sent()), ['foo:a|s', 'foo:b|s'])
+
+    def test_timing(self):
+        for ms in (1.0, 2.0, 3.0):
+            self.aggregator.timing('foo', ms)
+        self.aggregator.flush()
+        self.assertEqual(self.sent(), ['foo:1.000000|ms:2.000000|ms', 'foo:3.000000|ms'])
+
+    def test_flush_resets(self):
+        self.aggregator.count('foo', 1)
+        self.aggregator.flush()
+        self.aggregator.flush()
+        self.assertEqual(self.sent(), ['foo:1|c'])
+
+
+class TestAsyncStats(unittest.TestCase):
+    def test_send(self):
+        conn = mock.Mock()
+        async_conn = stats.AsyncStatsConnection(conn)
+        self.assertTrue(async_conn.send('foo:1|c'))
+        async_conn.close()
+        conn.send.assert_called_once_with('foo:1|c')
+        conn.flush.assert_called_with()
+
+    def test_queue_full(self):
+        release = threading.Event()
+        conn = mock.Mock()
+        conn.send.side_effect = lambda stat: release.wait(1.0)
+        async_conn = stats.AsyncStatsConnection(conn, queue_size=1)
+        results = [async_conn.send('foo:%i|c' % i) for i in range(10)]
+        release.set()
+        async_conn.close()
+        self.assertIn(False, results)
+        self.assertEqual(async_conn.dropped, results.count(False))
+
+    def test_flush_steady_traffic(self):
+        # The connection is flushed every flush_interval even though the
+        # queue never sits idle that long
+        conn = mock.Mock()
+        async_conn = stats.AsyncStatsConnection(conn, flush_interval=0.2)
+        for i in range(10):
+            async_conn.send('foo:1|c')
+            time.sleep(0.1)
+        self.assertTrue(conn.flush.call_count >= 3)
+        async_conn.close()
+
+
+    def test_restart_after_fork(self):
+        conn = mock.Mock()
+        async_conn = stats.AsyncStatsConnection(conn)
+        parent_sender = async_conn.sender
+        # Simulate fork(): the parent's sender thread is gone from the child,
+        # leaving a stat queued
+        async_conn.close()
+        parent_sender.join(1.0)
+        async_conn.queue.put_nowait('parent:1|c')
+        with mock.patch('os.getpid', return_value=os.getpid() + 1):
+            self.assertTrue(async_conn.send('child:1|c'))
+            self.assertTrue(async_conn.sender is not parent_sender)
+            async_conn.close()
+        conn.send.assert_called_once_with('child:1|c')
+
+
+class TestHistograms(unittest.TestCase):
+    def test_percentiles(self):
+        histogram = stats.Histogram()
+        for i in range(1, 1001):
+            histogram.record(float(i))
+        p50, p90, p99 = histogram.percentiles([50, 90, 99])
+        self.assertAlmostEqual(p50, 500.0, delta=5.0)
+        self.assertAlmostEqual(p90, 900.0, delta=9.0)
+        self.assertAlmostEqual(p99, 990.0, delta=9.9)
+        self.assertEqual(histogram.max, 1000.0)
+        self.assertEqual(histogram.count, 1000)
+
+    def test_bounded_buckets(self):
+        histogram = stats.Histogram()
+        for i in range(100000):
+            histogram.record(float(i % 100))
+        self.assertTrue(len(histogram.buckets) < 300)
+
+    def test_flush(self):
+        conn = mock.Mock()
+        histograms = stats.Histograms(conn)
+        histograms.record('foo', 10.0)
+        histograms.record('foo', 10.0)
+        histograms.flush()
+        lines = [args[0] for args, kwargs in conn.send.call_args_list]
+        self.assertEqual(len(lines), 5)
+        self.assertTrue(lines[0].startswith('foo.p50:'))
+        self.assertTrue(lines[1].startswith('foo.p90:'))
+        self.assertTrue(lines[2].startswith('foo.p99:'))
+        self.assertEqual(lines[3], 'foo.max:10.000000|g')
+        self.assertEqual(lines[4], 'foo.count:2|c')
+
+
+class TestShardedStats(unittest.TestCase):
+    def setUp(self):
+        self.servers = []
+        for i in range(3):
+            server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            server.bind(('127.0.0.1', 0))
+            self.servers.append(server)
+        self.hosts = ['127.0.0.1:%i' % server.getsockname()[1] for server in self.servers]
+        self.config = {'statsd': {'protocol': 'udp'}}
+
+    def tearDown(self):
+        for server in self.servers:
+            server.close()
+
+    def test_parse_hosts(self):
+        self.assertEqual(stats.parse_hosts(['a:1', 'b', {'host': 'c', 'port': 3}]),
+                         [('a', 1), ('b', 8125), ('c', 3)])
+
+    def test_consistent(self):
+        with mock.patch.dict(config.CONFIG.config, self.config):
+            conn = stats.ShardedStatsConnection(stats.parse_hosts(self.hosts))
+            keys = ['foo%i' % i for i in range(100)]
+            owners = [conn.get_connection(key) for key in keys]
+            self.assertEqual(len(set(owners)), 3)
+
+            # Removing a server only moves the keys it owned
+            other = stats.ShardedStatsConnection(stats.parse_hosts(self.hosts[:2]))
+            for key, owner in zip(keys, owners):
+                if owner.port != self.servers[2].getsockname()[1]:
+                    self.assertEqual(other.get_connection(key).port, owner.port)
+
+    def test_send(self):
+        with mock.patch.dict(config.CONFIG.config, self.config):
+            conn = stats.ShardedStatsConnection(stats.parse_hosts(self.hosts))
+            self.assertTrue(conn.send('foo:1|c'))
+        port = conn.get_connection('foo').port
+        server = [s for s in self.servers if s.getsockname()[1] == port][0]
+        self.assertEqual(server.recv(1024), 'foo:1|c\n')